@@ -1,68 +1,442 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import regex as re
 from datetime import datetime
-from io import BytesIO
-import openpyxl
-import matplotlib.pyplot as plt
-import json
-import seaborn as sns
-from keplergl import KeplerGl
 import os
-
-# Função para aplicar as transformações
-
-# Função para processar a coluna 'location_id'
-def process_location_id(x):
-    # Encontra todos os números na string
-    numbers = re.findall(r'\d+', x)
-    # Junta todos os números em uma única string
-    num_str = ''.join(numbers)
-    # Verifica se a string resultante tem exatamente 5 dígitos
-    if len(num_str) == 5:
-        return num_str
+import hashlib
+import numpy as np
+from collections.abc import Mapping
+from collections import OrderedDict
+import threading
+import sys
+import time
+import uuid
+import logging
+from processamento import (CLARO_PATH, ETAPAS, FORMATOS_EXPORTACAO, FAIXAS_ETARIAS,
+                           assinatura_arquivo, hash_arquivo, carregar_claro, calcular_resultado,
+                           exportar_bytes, agregar_ate_limite, agregar_em_grade)
+from calculadora_alvo import (TODAS_IDADES, TODOS_GENEROS, TODAS_CLASSES, interpretar_resposta,
+                              resposta_valida, montar_cubo, calcular_alvo, calcular_alvos,
+                              interpretar_audiencias)
+from tarefas import GerenciadorTarefas
+from instrumentacao import contexto, importar, medir, medicoes, rss_atual, pico_rss
+from armazenamento import (DIR_ARMAZENAMENTO, salvar_resultado, carregar_resultado, campanha_guardada,
+                           listar_campanhas, comparar_campanhas, distribuicao_campanhas)
+from estatisticas import ALFA
+
+# Orçamento de memória do cache de resultados processados (MB)
+LIMITE_CACHE_MB = int(os.environ.get('LIMITE_CACHE_MB', 1024))
+
+# Níveis de detalhe do mapa: tamanho da célula da grade em graus (None = pontos
+# individuais) e zoom inicial
+NIVEIS_MAPA = {
+    'País': (1.0, 3.5),
+    'Estado': (0.25, 5),
+    'Cidade': (0.05, 8),
+    'Bairro': (0.01, 10),
+    'Pontos': (None, 11),
+}
+
+# Máximo de pontos individuais enviados ao navegador no nível 'Pontos'
+LIMITE_PONTOS_MAPA = int(os.environ.get('LIMITE_PONTOS_MAPA', 20000))
+
+# Opções de linhas por página nas tabelas
+TAMANHOS_PAGINA = [50, 100, 500, 1000]
+
+# Tarefas em segundo plano rodando ao mesmo tempo e intervalo (s) entre as
+# atualizações da página enquanto alguma delas não termina
+MAX_TAREFAS = int(os.environ.get('MAX_TAREFAS', 4))
+INTERVALO_ATUALIZACAO = 0.5
+
+# Acima dessa quantidade de pontos o mapa Kepler recebe os dados agregados em grade
+LIMITE_PONTOS_KEPLER = int(os.environ.get('LIMITE_PONTOS_KEPLER', 5000))
+
+# Hash do conteúdo, recalculado apenas quando a assinatura muda
+@st.cache_data(show_spinner=False, max_entries=8)
+def hash_claro(caminho, assinatura):
+    return hash_arquivo(caminho)
+
+# Carrega o cadastro uma única vez por processo (compartilhado entre sessões).
+# A versão (hash do conteúdo) faz parte da chave, então o cache só é
+# invalidado quando o arquivo realmente muda.
+@st.cache_resource(show_spinner='Carregando cadastro de pontos...', max_entries=1)
+def carregar_claro_cache(caminho, versao):
+    return carregar_claro(caminho)
+
+def versao_claro(caminho=CLARO_PATH):
+    return hash_claro(caminho, assinatura_arquivo(caminho))
+
+def obter_claro(caminho=CLARO_PATH):
+    return carregar_claro_cache(caminho, versao_claro(caminho))
+
+# Tamanho aproximado em memória de um resultado (DataFrames, dicionários e
+# listas). Objetos referenciados em mais de um lugar contam uma vez só
+def tamanho_em_bytes(valor, vistos=None):
+    vistos = set() if vistos is None else vistos
+    if id(valor) in vistos:
+        return 0
+    vistos.add(id(valor))
+    if isinstance(valor, (pd.DataFrame, pd.Series)):
+        uso = valor.memory_usage(deep=True)
+        return int(uso.sum()) if isinstance(valor, pd.DataFrame) else int(uso)
+    if isinstance(valor, Mapping):
+        return sum(tamanho_em_bytes(item, vistos) for item in valor.values())
+    if isinstance(valor, (list, tuple)):
+        return sum(tamanho_em_bytes(item, vistos) for item in valor)
+    return sys.getsizeof(valor)
+
+# Cache LRU com orçamento de memória: ao passar do limite, os resultados
+# usados há mais tempo são descartados (o mais recente é sempre mantido)
+class CacheLRU:
+    def __init__(self, limite_bytes):
+        self.limite_bytes = limite_bytes
+        self.itens = OrderedDict()
+        self.trava = threading.Lock()
+
+    def obter(self, chave):
+        with self.trava:
+            if chave not in self.itens:
+                return None
+            self.itens.move_to_end(chave)
+            return self.itens[chave][0]
+
+    def guardar(self, chave, valor):
+        tamanho = tamanho_em_bytes(valor)
+        with self.trava:
+            self.itens[chave] = (valor, tamanho)
+            self.itens.move_to_end(chave)
+            while len(self.itens) > 1 and self.total_bytes() > self.limite_bytes:
+                self.itens.popitem(last=False)
+
+    def total_bytes(self):
+        return sum(tamanho for _, tamanho in self.itens.values())
+
+    def tamanho(self, chave):
+        with self.trava:
+            return self.itens[chave][1] if chave in self.itens else 0
+
+# Cache de resultados compartilhado por todas as sessões do processo
+@st.cache_resource
+def cache_resultados():
+    return CacheLRU(LIMITE_CACHE_MB * 1024 * 1024)
+
+# Hash do conteúdo do upload, calculado uma vez por arquivo enviado na sessão
+def hash_upload(uploaded_file):
+    hashes = st.session_state.setdefault('hash_uploads', {})
+    if uploaded_file.file_id not in hashes:
+        hashes[uploaded_file.file_id] = hashlib.md5(uploaded_file.getvalue()).hexdigest()
+    return hashes[uploaded_file.file_id]
+
+# Exportação guardada no cache de resultados por (hash do dataset, tabela,
+# colunas, formato), dentro do mesmo orçamento de memória dos resultados e
+# sem cópia a cada download. O DataFrame não entra na chave; o hash do
+# dataset já identifica o conteúdo.
+def gerar_exportacao(cache, df, chave, tabela, colunas, formato):
+    chave_exportacao = (chave, 'exportacao', tabela, colunas, formato)
+    dados = cache.obter(chave_exportacao)
+    if dados is None:
+        with contexto(dataset=chave):
+            dados = exportar_bytes(df[list(colunas)], formato)
+        cache.guardar(chave_exportacao, dados)
+    return dados
+
+# Posições das linhas ordenadas por uma coluna, calculadas uma vez por
+# (dataset, tabela, coluna, ordem) e compartilhadas sem cópia entre reruns
+@st.cache_resource(show_spinner=False, max_entries=64)
+def ordem_coluna(_df, chave, tabela, coluna, crescente):
+    serie = _df[coluna].reset_index(drop=True)
+    return serie.sort_values(ascending=crescente, kind='stable', na_position='last').index.to_numpy()
+
+# Máscara das linhas que passam pela busca e pelo mínimo de impressões
+@st.cache_resource(show_spinner=False, max_entries=64)
+def mascara_filtro(_df, chave, tabela, busca, minimo_impressoes):
+    mascara = np.ones(len(_df), dtype=bool)
+    if busca:
+        mascara &= _df['location_id'].astype(str).str.contains(busca, case=False, regex=False).to_numpy()
+    if minimo_impressoes:
+        mascara &= (_df['impressions'] >= minimo_impressoes).to_numpy()
+    return mascara
+
+# Tabela paginada: ordenação, busca e filtro acontecem no servidor e só a
+# página atual vai para o navegador
+def tabela_paginada(df, chave, tabela, colunas=None):
+    colunas = list(df.columns) if colunas is None else colunas
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        busca = st.text_input("Buscar location_id", key=f"{tabela}_busca")
+    with col2:
+        minimo_impressoes = st.number_input("Impressions mínimas", min_value=0, value=0, key=f"{tabela}_minimo")
+    with col3:
+        coluna = st.selectbox("Ordenar por", options=[None] + colunas, key=f"{tabela}_ordenar")
+    with col4:
+        crescente = st.radio("Ordem", options=['Crescente', 'Decrescente'], horizontal=True,
+                             key=f"{tabela}_ordem") == 'Crescente'
+
+    posicoes = np.arange(len(df)) if coluna is None else ordem_coluna(df, chave, tabela, coluna, crescente)
+    if busca or minimo_impressoes:
+        posicoes = posicoes[mascara_filtro(df, chave, tabela, busca, minimo_impressoes)[posicoes]]
+
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        tamanho_pagina = st.selectbox("Linhas por página", options=TAMANHOS_PAGINA, key=f"{tabela}_tamanho")
+    paginas = max(1, -(-len(posicoes) // tamanho_pagina))
+    with col2:
+        pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1,
+                                 key=f"{tabela}_pagina")
+
+    inicio = (pagina - 1) * tamanho_pagina
+    st.dataframe(df.iloc[posicoes[inicio:inicio + tamanho_pagina]][colunas])
+    st.caption(f"{len(posicoes)} linhas de {len(df)}")
+
+# Botões de download com geração sob demanda: o arquivo só é montado
+# quando o usuário clica no botão
+def botoes_download(df, chave, tabela, nome_arquivo):
+    colunas = tuple(df.columns)
+    cache = cache_resultados()
+    for formato, (extensao, mime) in FORMATOS_EXPORTACAO.items():
+        st.download_button(
+            label=f"📁 Baixar {formato} Processado",
+            data=lambda formato=formato: gerar_exportacao(cache, df, chave, tabela, colunas, formato),
+            file_name=f"{nome_arquivo}.{extensao}",
+            mime=mime,
+            key=f"download_{tabela}_{extensao}",
+            on_click='ignore'
+        )
+
+# Dados do mapa para um nível de detalhe, agregados no servidor e reduzidos às
+# colunas que a camada usa (coordenadas arredondadas, pesos inteiros)
+@st.cache_data(show_spinner=False, max_entries=32)
+def dados_mapa(_final, chave, tamanho_celula, peso):
+    if tamanho_celula is None:
+        dados = _final[['latitude', 'longitude', 'impressions', 'uniques']].dropna(subset=['latitude', 'longitude'])
+        dados = dados.nlargest(LIMITE_PONTOS_MAPA, peso).assign(pontos=1)
     else:
-        # Se tiver menos que 5 dígitos, retorna o valor original
-        return x
-        
-def processar_arquivo(df, claro):
-    colunas_para_manter = ['location_id', 'impressions', 'uniques']
-
-    # Verifica se as colunas padrão existem
-    colunas_esperadas = ['class', 'location_id', 'gender_group', 'country', 'date', 'age_group', 'impression_hour', 'num_total_impressions', 'home']
-    
-    if all(coluna in df.columns for coluna in colunas_esperadas):
-        df1 = df[((df['class'].isnull()) & (~df['location_id'].isnull()) & 
-                  (df['gender_group'].isnull()) & (df['country'].isnull()) & 
-                  (df['date'].isnull()) & (df['age_group'].isnull()) & 
-                  (df['impression_hour'].isnull()) & (df['num_total_impressions'].isnull()) & 
-                  (df['home'].isnull()))]
+        dados = agregar_em_grade(_final, tamanho_celula)
+    return pd.DataFrame({
+        'lat': dados['latitude'].round(5).astype('float32'),
+        'lon': dados['longitude'].round(5).astype('float32'),
+        'peso': dados[peso].round().astype('int64'),
+        'pontos': dados['pontos'].astype('int32'),
+    })
+
+# Mapa pydeck: colunas 3D por célula da grade, ou círculos nos pontos individuais
+def mapa_pydeck(dados, tamanho_celula, zoom):
+    pdk = importar('pydeck')
+    escala = 1 / max(dados['peso'].max(), 1)
+    if tamanho_celula is None:
+        camada = pdk.Layer('ScatterplotLayer', data=dados, get_position='[lon, lat]',
+                           get_radius=f'50 + 450 * peso * {escala}', radius_min_pixels=2,
+                           get_fill_color=[200, 30, 0, 160], pickable=True)
     else:
-        # Executa o código alternativo com nomes de colunas diferentes
-        df1 = df[((df['social_class'].isnull()) & (~df['location_id'].isnull()) & 
-                  (df['gender'].isnull()) & (df['nationality'].isnull()) & 
-                  (df['date'].isnull()) & (df['age'].isnull()) & 
-                  (df['impression_hour'].isnull()) & (df['num_total_impressions'].isnull()) & 
-                  (df['residence_name'].isnull()))]
-
-    df1 = df1.sort_values('impressions', ascending=False)
-    df1 = df1[[coluna for coluna in df.columns if coluna in colunas_para_manter]].reset_index(drop=True)
-    
-    claro = claro.rename(columns={'id': 'location_id'})
-    #claro = claro[['location_id', 'latitude', 'longitude']]
-    
-    df1['location_id'] = df1['location_id'].astype(str)
-
-    # Aplica a função na coluna 'location_id'
-
-    final = df1.merge(claro, on='location_id')
-    final['location_id'] = final['location_id'].apply(process_location_id)
-    # Excluir colunas totalmente vazias
-    final = final.dropna(axis=1, how='all')
-
-    return final
+        # Raio da coluna proporcional ao tamanho da célula (1 grau ~ 111 km)
+        camada = pdk.Layer('ColumnLayer', data=dados, get_position='[lon, lat]',
+                           radius=tamanho_celula * 111_000 * 0.45, elevation_scale=1,
+                           get_elevation=f'peso * {escala} * {tamanho_celula * 111_000 * 20}',
+                           get_fill_color=f'[255, 140 * (1 - peso * {escala}), 0, 180]',
+                           extruded=True, pickable=True)
+    centro = pdk.ViewState(latitude=float(dados['lat'].mean()), longitude=float(dados['lon'].mean()),
+                           zoom=zoom, pitch=40 if tamanho_celula else 0)
+    return pdk.Deck(layers=[camada], initial_view_state=centro,
+                    tooltip={'text': 'Peso: {peso}\nPontos: {pontos}'})
+
+# HTML do mapa Kepler gerado em memória (sem arquivo em disco). Com muitos
+# pontos, envia a grade agregada no lugar das linhas.
+def gerar_html_kepler(tarefa, chave, final, limite_pontos):
+    tarefa.verificar()
+    with contexto(dataset=chave), medir('kepler', len(final)) as medicao:
+        if len(final) > limite_pontos:
+            dados, tamanho_celula = agregar_ate_limite(final, limite_pontos)
+            nome = f"Dados Geográficos (grade de {tamanho_celula:g}°)"
+        else:
+            dados, nome = final, "Dados Geográficos"
+        mapa = importar('keplergl').KeplerGl(height=400)
+        mapa.add_data(data=dados, name=nome)
+        medicao.linhas_saida = len(dados)
+        return mapa._repr_html_().decode('utf-8')
+
+# Pool de tarefas em segundo plano compartilhado por todas as sessões do processo
+@st.cache_resource
+def gerenciador_tarefas():
+    return GerenciadorTarefas(MAX_TAREFAS)
+
+# Identificador da sessão, usado para saber quem ainda espera cada tarefa
+def id_sessao():
+    return st.session_state.setdefault('id_sessao', uuid.uuid4().hex)
+
+# Pipeline do upload rodando como tarefa: etapas e progresso da leitura são
+# publicados na tarefa, e as partes prontas ficam em tarefa.parcial. O
+# resultado é guardado em disco para reabrir a campanha sem reprocessar (uma
+# falha ao gravar não impede o uso do resultado: ela vai para o log e fica em
+# resultado['erro_armazenamento'] para a página avisar) e entregue ao cache
+# assim que termina, mesmo que nenhuma sessão volte para buscá-lo
+def processar_em_segundo_plano(tarefa, uploaded_file, claro, cache):
+    with contexto(dataset=tarefa.chave, arquivo=uploaded_file.name):
+        resultado = calcular_resultado(uploaded_file, uploaded_file.name, claro,
+                                       progresso=tarefa.progresso, etapa=tarefa.avancar, parcial=tarefa.parcial)
+        try:
+            with medir('armazenar'):
+                salvar_resultado(tarefa.chave, resultado, uploaded_file.name)
+        except OSError as e:
+            logging.warning("Campanha %s (%s) não foi guardada em disco: %s", tarefa.chave, uploaded_file.name, e)
+            resultado['erro_armazenamento'] = str(e)
+        cache.guardar(tarefa.chave, resultado)
+        return resultado
+
+# Resultado já processado: primeiro no cache em memória, depois nas campanhas
+# guardadas em disco (que passa a ficar também no cache). Enquanto uma tarefa
+# processa o arquivo, as atualizações da página não procuram no disco
+def resultado_guardado(chave):
+    resultado = cache_resultados().obter(chave)
+    tarefa = gerenciador_tarefas().obter(chave)
+    if resultado is not None or (tarefa is not None and not tarefa.concluida()) or not campanha_guardada(chave):
+        return resultado
+    with contexto(dataset=chave), medir('carregar_armazenado') as medicao:
+        resultado = carregar_resultado(chave)
+        medicao.linhas_saida = None if resultado is None else len(resultado['final'])
+    if resultado is not None:
+        cache_resultados().guardar(chave, resultado)
+    return resultado
+
+# Campanhas guardadas em disco. A listagem é refeita quando o diretório muda
+# (campanha gravada ou apagada)
+@st.cache_data(show_spinner=False, max_entries=4)
+def campanhas_guardadas(raiz, assinatura):
+    return listar_campanhas(raiz)
+
+def obter_campanhas(raiz=DIR_ARMAZENAMENTO):
+    assinatura = os.stat(raiz).st_mtime_ns if os.path.isdir(raiz) else None
+    return {manifesto['chave']: manifesto for manifesto in campanhas_guardadas(raiz, assinatura)}
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def comparacao_campanhas(chaves, assinatura):
+    return (*comparar_campanhas(list(chaves)), distribuicao_campanhas(list(chaves)))
+
+# Comparação de indicadores e impressões diárias entre campanhas guardadas
+def painel_comparacao(campanhas, selecionadas):
+    st.header("Comparação de campanhas")
+    try:
+        indicadores, diario, distribuicao = comparacao_campanhas(tuple(selecionadas), tuple(
+            campanhas[chave]['processado_em'] for chave in selecionadas))
+    except (OSError, ValueError, KeyError):
+        st.warning("Não foi possível ler uma das campanhas selecionadas. Ela pode ter sido removida.")
+        return
+    st.dataframe(indicadores, width='stretch', hide_index=True)
+    px = importar('plotly.express')
+    fig = px.line(diario, x='date', y='impressions', color='campanha',
+                  title='Impressions por dia')
+    st.plotly_chart(fig, width='stretch')
+
+    # Distribuição por ponto, juntando os esboços guardados das campanhas
+    if not distribuicao.empty:
+        st.subheader("Distribuição por ponto")
+        st.dataframe(distribuicao.round(2), width='stretch', hide_index=True)
+        st.caption(f"Percentis aproximados (erro relativo de até {ALFA:.0%}).")
+
+# Inicia (ou acompanha) o processamento do upload. Um upload novo na sessão
+# libera a tarefa do arquivo anterior, que é cancelada se ninguém mais a
+# espera. Retorna o resultado (parcial enquanto a tarefa roda) e a tarefa,
+# ou None no lugar dela quando o processamento terminou
+def acompanhar_processamento(uploaded_file, chave, claro):
+    anterior = st.session_state.get('tarefa_processamento')
+    if anterior is not None and anterior != chave:
+        liberar_processamento()
+    st.session_state['tarefa_processamento'] = chave
+
+    tarefa = gerenciador_tarefas().submeter(chave, id_sessao(), processar_em_segundo_plano,
+                                            uploaded_file, claro, cache_resultados())
+    if not tarefa.concluida():
+        # Cópia das partes prontas: a tarefa continua acrescentando partes, e
+        # a página precisa ver as mesmas do início ao fim da execução
+        return dict(tarefa.parcial), tarefa
+    try:
+        resultado = tarefa.resultado()
+        cache_resultados().guardar(chave, resultado)
+    finally:
+        gerenciador_tarefas().remover(chave)
+    return resultado, None
+
+# As tarefas do último upload da sessão (processamento e mapa Kepler)
+# deixam de ser esperadas por ela
+def liberar_processamento():
+    anterior = st.session_state.pop('tarefa_processamento', None)
+    if anterior is not None:
+        gerenciador_tarefas().liberar(anterior, id_sessao())
+        gerenciador_tarefas().liberar(f"kepler-{anterior}", id_sessao())
+
+# Barra com a etapa atual e o progresso geral do processamento
+def mostrar_progresso(tarefa):
+    etapas = list(ETAPAS)
+    posicao = etapas.index(tarefa.etapa) if tarefa.etapa in ETAPAS else 0
+    texto = ETAPAS.get(tarefa.etapa, 'Aguardando na fila')
+    st.progress((posicao + tarefa.fracao) / len(etapas),
+                text=f"{texto}... (etapa {posicao + 1} de {len(etapas)})")
+
+# Aviso no lugar de uma aba cujos dados ainda estão sendo calculados
+def aguardar_etapa(etapa):
+    st.info(f"Processando: esta aba aparece quando a etapa '{ETAPAS[etapa]}' terminar.")
+
+# HTML do Kepler guardado junto com o resultado do dataset. Enquanto não
+# existe, é gerado por uma tarefa em segundo plano (retorna None até terminar).
+# Com o processamento ainda rodando, o resultado da página é uma cópia das
+# partes prontas: o HTML fica na tarefa do Kepler, que é reaproveitada nos
+# reruns seguintes e só passa para o resultado quando ele está no cache
+def acompanhar_kepler(resultado, chave, resultado_completo):
+    if 'kepler_html' in resultado:
+        return resultado['kepler_html']
+    chave_tarefa = f"kepler-{chave}"
+    tarefa = gerenciador_tarefas().submeter(chave_tarefa, id_sessao(), gerar_html_kepler,
+                                            chave, resultado['final'], LIMITE_PONTOS_KEPLER)
+    if not tarefa.concluida():
+        return None
+    if not resultado_completo:
+        return tarefa.resultado()
+    try:
+        resultado['kepler_html'] = tarefa.resultado()
+    finally:
+        gerenciador_tarefas().remover(chave_tarefa)
+    # Atualiza o tamanho do resultado no cache com o HTML
+    cache_resultados().guardar(chave, resultado)
+    return resultado['kepler_html']
+
+# Resposta da API lida sem eval e convertida no cubo de audiência, uma vez
+# por texto colado (None quando faltam blocos na resposta)
+@st.cache_data(show_spinner=False, max_entries=64)
+def cubo_resposta(texto):
+    response = interpretar_resposta(texto)
+    return montar_cubo(response) if resposta_valida(response) else None
+
+# Painel de memória na barra lateral: o que o resultado desta sessão ocupa no
+# cache e a memória residente do processo. A memória residente é do processo
+# inteiro (todas as sessões); a sessão só guarda o maior valor visto nas suas
+# execuções
+def painel_memoria(chave):
+    rss = rss_atual()
+    maior_rss_visto = max(st.session_state.get('maior_rss_visto', 0), rss)
+    st.session_state['maior_rss_visto'] = maior_rss_visto
+    with st.sidebar.expander("Memória"):
+        st.write(f"Resultado desta sessão: {cache_resultados().tamanho(chave) / 1024**2:.1f} MB")
+        st.write(f"Cache compartilhado: {cache_resultados().total_bytes() / 1024**2:.1f} MB "
+                 f"de {LIMITE_CACHE_MB} MB")
+        st.write(f"Processo agora: {rss / 1024**2:.1f} MB")
+        st.write(f"Maior uso do processo visto por esta sessão: {maior_rss_visto / 1024**2:.1f} MB")
+        st.write(f"Pico do processo: {max(pico_rss(), rss) / 1024**2:.1f} MB")
+
+# Painel opcional com as medições das etapas: as do dataset aberto na sessão
+# e as do processo que não pertencem a nenhum dataset (carga do cadastro)
+def painel_diagnostico(chave):
+    if not st.sidebar.toggle("Diagnóstico de desempenho", key='mostrar_diagnostico'):
+        return
+    st.header("Diagnóstico de desempenho")
+    colunas = ['momento', 'etapa', 'segundos', 'linhas_entrada', 'linhas_saida', 'pico_mb',
+               'acrescimo_mb', 'thread', 'erro']
+    do_dataset = pd.DataFrame(medicoes(dataset=chave), columns=colunas)
+    if do_dataset.empty:
+        st.write("Nenhuma medição registrada para este arquivo neste processo.")
+    else:
+        st.dataframe(do_dataset, width='stretch', hide_index=True)
+    gerais = pd.DataFrame(medicoes(dataset=None), columns=colunas)
+    if not gerais.empty:
+        st.subheader("Outras etapas do processo")
+        st.dataframe(gerais.tail(20), width='stretch', hide_index=True)
 
 # Interface do Streamlit
 st.set_page_config(page_title='Processamento de Arquivo', layout='wide')
@@ -82,45 +456,65 @@ with col1:
 # Upload do arquivo CSV ou Parquet
 uploaded_file = st.file_uploader("Escolha um arquivo CSV ou Parquet para o dataset principal", type=["csv", "parquet"])
 
-if uploaded_file is not None:
+# Campanhas já processadas, guardadas em disco: reabrir uma delas (quando não
+# há upload) e comparar várias
+campanhas = obter_campanhas()
+campanha_aberta = st.sidebar.selectbox(
+    "Campanhas processadas", options=[None] + list(campanhas),
+    format_func=lambda chave: "—" if chave is None else
+    f"{campanhas[chave]['nome']} ({campanhas[chave]['processado_em'].replace('T', ' ')})",
+    key='campanha_aberta')
+campanhas_comparadas = st.sidebar.multiselect(
+    "Comparar campanhas", options=list(campanhas),
+    format_func=lambda chave: f"{campanhas[chave]['nome']} ({campanhas[chave]['processado_em'].replace('T', ' ')})",
+    key='campanhas_comparadas')
+if len(campanhas_comparadas) >= 2:
+    painel_comparacao(campanhas, campanhas_comparadas)
+
+if uploaded_file is not None or campanha_aberta is not None:
     try:
-        # Obter o nome do arquivo enviado
-        original_filename = os.path.splitext(uploaded_file.name)[0]
-
-        # Leitura do arquivo claro diretamente do computador
-        claro_path = 'claro.csv'  # Atualize com o caminho do seu arquivo
-        claro = pd.read_csv(claro_path, encoding='latin-1', low_memory=False)
-
-        # Leitura do arquivo CSV ou Parquet do dataset principal
-        if uploaded_file.name.endswith('.csv'):
-            df = pd.read_csv(uploaded_file, encoding='latin-1', low_memory=False)
-        elif uploaded_file.name.endswith('.parquet'):
-            df = pd.read_parquet(uploaded_file, low_memory=False)
-        
-        # Exibindo o período das datas, se as colunas existirem
-        if 'start_date' in df.columns and 'end_date' in df.columns:
-            df['start_date'] = pd.to_datetime(df['start_date'], errors='coerce')
-            df['end_date'] = pd.to_datetime(df['end_date'], errors='coerce')
-            
-            # Verifica se existem valores não nulos
-            if not df['start_date'].dropna().empty and not df['end_date'].dropna().empty:
-                start_date = df['start_date'].dropna().iloc[0]
-                end_date = df['end_date'].dropna().iloc[0]
-                dias = (end_date - start_date).days + 1  # Adiciona 1 ao cálculo dos dias
-                periodo_info = f"Período do arquivo: {start_date.strftime('%Y-%m-%d')} até {end_date.strftime('%Y-%m-%d')} ({dias} dias)"
-            else:
-                periodo_info = "Não há datas válidas no arquivo."
-        else:
-            periodo_info = "Colunas 'start_date' e/ou 'end_date' não encontradas no arquivo."
-        
-        # Processamento do arquivo
-        final = processar_arquivo(df, claro)
+        if uploaded_file is not None:
+            # Obter o nome do arquivo enviado
+            original_filename = os.path.splitext(uploaded_file.name)[0]
 
-        # Criar coluna frequência
-        final['frequencia'] = round(final['impressions']/final['uniques'], 2)
-
-        # Criar uma lista das colunas preenchidas (não vazias)
-        colunas_preenchidas = final.columns.tolist()
+            # Identificador do conteúdo enviado + versão do cadastro, usado como chave dos caches
+            chave_dataset = f"{hash_upload(uploaded_file)}-{versao_claro()}"
+        else:
+            original_filename = os.path.splitext(campanhas[campanha_aberta]['nome'])[0]
+            chave_dataset = campanha_aberta
+
+        # Resultado processado em cache ou em disco (por conteúdo do arquivo +
+        # versão do cadastro); mudanças de widgets e novos envios do mesmo
+        # arquivo reaproveitam tudo sem reprocessar. Sem resultado guardado, o
+        # processamento roda em segundo plano e cada aba aparece quando as
+        # etapas de que ela depende terminam
+        resultado = resultado_guardado(chave_dataset)
+        tarefa = None
+        if resultado is None and uploaded_file is None:
+            raise FileNotFoundError("a campanha selecionada não está mais guardada")
+        anterior = st.session_state.get('tarefa_processamento')
+        if resultado is not None and anterior is not None:
+            if anterior != chave_dataset:
+                liberar_processamento()
+            else:
+                # Processamento concluído e já no cache: a sessão não espera mais a tarefa
+                gerenciador_tarefas().liberar(chave_dataset, id_sessao())
+        if resultado is None:
+            # Cadastro de pontos (carregado uma vez e compartilhado entre sessões)
+            claro = obter_claro()
+            resultado, tarefa = acompanhar_processamento(uploaded_file, chave_dataset, claro)
+        em_andamento = tarefa is not None
+        if em_andamento:
+            mostrar_progresso(tarefa)
+        if 'erro_armazenamento' in resultado:
+            st.warning(f"Não foi possível guardar esta campanha em disco ({resultado['erro_armazenamento']}): "
+                       "ela não vai aparecer em \"Campanhas processadas\" e será reprocessada se o servidor reiniciar.")
+
+        final = resultado.get('final')
+        periodo_info = resultado.get('periodo_info')
+        resumo = resultado.get('resumo')
+        df_data_filtrado = resultado.get('df_data_filtrado')
+        graficos = resultado.get('graficos')
 
         colunas_padrao = ['location_id', 'impressions', 'uniques']
 
@@ -134,331 +528,225 @@ if uploaded_file is not None:
                                                     "KeplerGL"])
 
         with tab1:
-            st.header("Ponto a Ponto")
-            st.write("Seleção de Colunas para Download:")
-            colunas_selecionadas = st.multiselect(
-                "Escolha as colunas que deseja incluir no download:",
-                options=colunas_preenchidas,
-                default=colunas_padrao
-            )
-
-            # Filtrar o DataFrame com base nas colunas selecionadas
-            final_filtrado = final[colunas_selecionadas]
-            st.dataframe(final_filtrado)
-
-            # Criar buffers para arquivos
-            output_csv = BytesIO()
-            output_excel = BytesIO()
-
-            # Definir o nome do arquivo processado CSV
-            processed_filename_csv = f"{original_filename}_processado_{datetime.now().strftime('%Y-%m-%d')}.csv"
-
-            # Definir o nome do arquivo processado EXCEL
-            processed_filename_xlsx = f"{original_filename}_processado_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
-
-            # Criar o CSV
-            final_filtrado.to_csv(output_csv, index=False)
-            output_csv.seek(0)
-
-            # Criar o Excel
-            with pd.ExcelWriter(output_excel, engine='openpyxl') as writer:
-                final_filtrado.to_excel(writer, index=False, sheet_name='Dados Processados')
-            output_excel.seek(0)
-
-            st.download_button(
-                label="📁 Baixar CSV Processado",
-                data=output_csv,
-                file_name=processed_filename_csv,
-                mime="text/csv"
-            )
-
-            st.download_button(
-                label="📁 Baixar Excel Processado",
-                data=output_excel,
-                file_name=processed_filename_xlsx,
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
+            if 'final' in resultado:
+                st.header("Ponto a Ponto")
+
+                # Criar uma lista das colunas preenchidas (não vazias)
+                colunas_preenchidas = final.columns.tolist()
+
+                st.write("Seleção de Colunas para Download:")
+                colunas_selecionadas = st.multiselect(
+                    "Escolha as colunas que deseja incluir no download:",
+                    options=colunas_preenchidas,
+                    default=colunas_padrao
+                )
+
+                # Filtrar o DataFrame com base nas colunas selecionadas
+                final_filtrado = final[colunas_selecionadas]
+                tabela_paginada(final, chave_dataset, 'ponto', colunas_selecionadas)
+
+                # Pontos do arquivo que não existem no cadastro (ficam fora do resultado)
+                sem_cadastro = resultado['sem_cadastro']
+                if not sem_cadastro.empty:
+                    st.warning(f"{len(sem_cadastro)} location_id do arquivo não foram encontrados no cadastro "
+                               f"e ficaram fora da tabela.")
+                    with st.expander("Ver pontos sem cadastro"):
+                        st.dataframe(sem_cadastro)
+
+                # Nome base do arquivo processado
+                processed_filename = f"{original_filename}_processado_{datetime.now().strftime('%Y-%m-%d')}"
+
+                # Downloads gerados só quando solicitados
+                botoes_download(final_filtrado, chave_dataset, 'ponto', processed_filename)
+            else:
+                aguardar_etapa('juncao')
         with tab2:
-            st.header("Estatísticas Descritivas")
-            col1, col2 = st.columns(2)
-            col3, col4 = st.columns(2)
-
-            with col1:
-                st.write(f"Quantidade de location_id: {final['location_id'].nunique()}")
-                st.write(periodo_info)
-
-                # Cálculo das somas de 'uniques' por classe
-                lista_classes = ['A', 'B1', 'B2', 'C1', 'C2', 'DE']
-                df_classe = df[((~df['class'].isnull()) & 
-                                (df['location_id'].isnull()) & 
-                                (df['gender_group'].isnull()) & 
-                                (df['country'].isnull()) & 
-                                (df['date'].isnull()) & 
-                                (df['age_group'].isnull()) & 
-                                (df['impression_hour'].isnull()) & 
-                                (df['num_total_impressions'].isnull()) & 
-                                (df['home'].isnull()))]
-
-                total_por_classe = df_classe[df_classe['class'].isin(lista_classes)].groupby('class')['uniques'].sum().to_dict()
-
-                # Cálculo do total de alcance
-                total_alcance = df[((df['class'].isnull()) & 
-                                    (df['location_id'].isnull()) & 
-                                    (df['gender_group'].isnull()) & 
-                                    (df['country'].isnull()) & 
-                                    (df['date'].isnull()) & 
-                                    (df['age_group'].isnull()) & 
-                                    (df['impression_hour'].isnull()) & 
-                                    (df['num_total_impressions'].isnull()) & 
-                                    (df['home'].isnull()))]['uniques'].sum()
-                # Cálculo do total de alcance
-                total_impactos = df[((df['class'].isnull()) & 
-                                    (df['location_id'].isnull()) & 
-                                    (df['gender_group'].isnull()) & 
-                                    (df['country'].isnull()) & 
-                                    (df['date'].isnull()) & 
-                                    (df['age_group'].isnull()) & 
-                                    (df['impression_hour'].isnull()) & 
-                                    (df['num_total_impressions'].isnull()) & 
-                                    (df['home'].isnull()))]['impressions'].sum()
-
-                # Cálculo da porcentagem por classe
-                porcentagem_por_classe = {classe: (total / total_alcance) * 100 
-                                        for classe, total in total_por_classe.items()}
-
-            with col2:
-                # Cálculo das somas de 'uniques' por gênero
-                lista_genero = ['F', 'M']
-                df_genero = df[((df['class'].isnull()) & 
-                                (df['location_id'].isnull()) & 
-                                ~(df['gender_group'].isnull()) & 
-                                (df['country'].isnull()) & 
-                                (df['date'].isnull()) & 
-                                ~(df['age_group'].isnull()) & 
-                                (df['impression_hour'].isnull()) & 
-                                (df['num_total_impressions'].isnull()) & 
-                                (df['home'].isnull()))]
-
-                total_por_genero = df_genero[(df_genero['gender_group'].isin(lista_genero))].groupby('gender_group')['uniques'].sum().to_dict()
-
-                # Cálculo da porcentagem por gênero
-                porcentagem_por_genero = {genero: (total / total_alcance) * 100 
-                                        for genero, total in total_por_genero.items()}
-
-                # Cálculo das somas de 'uniques' por faixa etária
-                lista_idade = [20, 30, 40, 50, 60, 70, 80]
-                df_idade = df[((df['class'].isnull()) & 
-                            (df['location_id'].isnull()) & 
-                            ~(df['gender_group'].isnull()) & 
-                            (df['country'].isnull()) & 
-                            (df['date'].isnull()) & 
-                            ~(df['age_group'].isnull()) & 
-                            (df['impression_hour'].isnull()) & 
-                            (df['num_total_impressions'].isnull()) & 
-                            (df['home'].isnull()))]
-
-                total_por_idade = df_idade[(df_idade['age_group'].isin(lista_idade))].groupby('age_group')['uniques'].sum().to_dict()
-
-                # Cálculo da porcentagem por faixa etária
-                porcentagem_por_idade = {idade: (total / total_alcance) * 100 
-                                        for idade, total in total_por_idade.items()}
-            with col3:
-                if 'impressions' in final.columns:
-                    st.subheader("Estatísticas de 'impressions'")
-                    impressions_describe = round(final['impressions'].describe(),2)
-                    st.write(f"Contagem: {impressions_describe['count']}")
-                    st.write(f"Média: {impressions_describe['mean']:.2f}")
-                    st.write(f"Desvio Padrão: {impressions_describe['std']:.2f}")
-                    st.write(f"Mínimo: {impressions_describe['min']}")
-                    st.write(f"25º Percentil: {impressions_describe['25%']}")
-                    st.write(f"Mediana (50º Percentil): {impressions_describe['50%']}")
-                    st.write(f"75º Percentil: {impressions_describe['75%']}")
-                    st.write(f"Máximo: {impressions_describe['max']}")
-
-                if 'uniques' in final.columns:
-                    st.subheader("Estatísticas de 'uniques'")
-                    uniques_describe = round(final['uniques'].describe(), 2)
-                    st.write(f"Contagem: {uniques_describe['count']}")
-                    st.write(f"Média: {uniques_describe['mean']:.2f}")
-                    st.write(f"Desvio Padrão: {uniques_describe['std']:.2f}")
-                    st.write(f"Mínimo: {uniques_describe['min']}")
-                    st.write(f"25º Percentil: {uniques_describe['25%']}")
-                    st.write(f"Mediana (50º Percentil): {uniques_describe['50%']}")
-                    st.write(f"75º Percentil: {uniques_describe['75%']}")
-                    st.write(f"Máximo: {uniques_describe['max']}")
-            with col4:
-                st.subheader('Alcance')
-                st.write(f'{total_alcance}')
-                st.subheader('Impactos')
-                st.write(f'{total_impactos}')
+            if 'resumo' in resultado:
+                st.header("Estatísticas Descritivas")
+                porcentagem_por_classe = resumo['porcentagem_por_classe']
+                porcentagem_por_genero = resumo['porcentagem_por_genero']
+                porcentagem_por_idade = resumo['porcentagem_por_idade']
+
+                col1, col2 = st.columns(2)
+                col3, col4 = st.columns(2)
+
+                with col1:
+                    st.write(f"Quantidade de location_id: {resumo['quantidade_location_id']}")
+                    st.write(periodo_info)
+
+                with col3:
+                    if 'impressions' in final.columns:
+                        st.subheader("Estatísticas de 'impressions'")
+                        impressions_describe = resumo['impressions_describe']
+                        st.write(f"Contagem: {impressions_describe['count']}")
+                        st.write(f"Média: {impressions_describe['mean']:.2f}")
+                        st.write(f"Desvio Padrão: {impressions_describe['std']:.2f}")
+                        st.write(f"Mínimo: {impressions_describe['min']}")
+                        st.write(f"25º Percentil: {impressions_describe['25%']}")
+                        st.write(f"Mediana (50º Percentil): {impressions_describe['50%']}")
+                        st.write(f"75º Percentil: {impressions_describe['75%']}")
+                        st.write(f"Máximo: {impressions_describe['max']}")
+
+                    if 'uniques' in final.columns:
+                        st.subheader("Estatísticas de 'uniques'")
+                        uniques_describe = resumo['uniques_describe']
+                        st.write(f"Contagem: {uniques_describe['count']}")
+                        st.write(f"Média: {uniques_describe['mean']:.2f}")
+                        st.write(f"Desvio Padrão: {uniques_describe['std']:.2f}")
+                        st.write(f"Mínimo: {uniques_describe['min']}")
+                        st.write(f"25º Percentil: {uniques_describe['25%']}")
+                        st.write(f"Mediana (50º Percentil): {uniques_describe['50%']}")
+                        st.write(f"75º Percentil: {uniques_describe['75%']}")
+                        st.write(f"Máximo: {uniques_describe['max']}")
+                with col4:
+                    st.subheader('Alcance')
+                    st.write(f"{resumo['total_alcance']}")
+                    st.subheader('Impactos')
+                    st.write(f"{resumo['total_impactos']}")
             
-                # Exibir porcentagens por classe
-                st.subheader("Porcentagem por Classe Social")
-                for classe, porcentagem in porcentagem_por_classe.items():
-                    st.write(f"{classe}: {porcentagem:.2f}%")
-
-                # Exibir porcentagens por gênero
-                st.subheader("Porcentagem por Gênero")
-                for genero, porcentagem in porcentagem_por_genero.items():
-                    genero_dict = {
-                        'F': 'Feminino',
-                        'M': 'Masculino'
-                    }
-                    faixa_genero = genero_dict.get(genero, genero)
-                    st.write(f"{faixa_genero}: {porcentagem:.2f}%")
-
-                # Exibir porcentagens por faixa etária
-                st.subheader("Porcentagem por Faixa Etária")
-                faixas_etarias = {
-                    20: '20-29',
-                    30: '30-39',
-                    40: '40-49',
-                    50: '50-59',
-                    60: '60-69',
-                    70: '70-79',
-                    80: '80+'
-                }
-                for idade, porcentagem in porcentagem_por_idade.items():
-                    faixa = faixas_etarias.get(idade, idade)
-                    st.write(f"{faixa}: {porcentagem:.2f}%")
+                    # Exibir porcentagens por classe
+                    st.subheader("Porcentagem por Classe Social")
+                    for classe, porcentagem in porcentagem_por_classe.items():
+                        st.write(f"{classe}: {porcentagem:.2f}%")
+
+                    # Exibir porcentagens por gênero
+                    st.subheader("Porcentagem por Gênero")
+                    for genero, porcentagem in porcentagem_por_genero.items():
+                        genero_dict = {
+                            'F': 'Feminino',
+                            'M': 'Masculino'
+                        }
+                        faixa_genero = genero_dict.get(genero, genero)
+                        st.write(f"{faixa_genero}: {porcentagem:.2f}%")
+
+                    # Exibir porcentagens por faixa etária
+                    st.subheader("Porcentagem por Faixa Etária")
+                    for idade, porcentagem in porcentagem_por_idade.items():
+                        faixa = FAIXAS_ETARIAS.get(idade, idade)
+                        st.write(f"{faixa}: {porcentagem:.2f}%")
+            else:
+                aguardar_etapa('resumo')
         with tab3:
-            st.header('Visualização dos pontos em um Mapa')
-            st.write('Para visualizar no mapa, necessita das colunas "Latitude" e "Longitude"')
-            st.map(final[['latitude', 'longitude']])
+            if 'final' in resultado:
+                st.header('Visualização dos pontos em um Mapa')
+                st.write('Para visualizar no mapa, necessita das colunas "Latitude" e "Longitude"')
+                col1, col2 = st.columns(2)
+                with col1:
+                    nivel = st.select_slider("Nível de detalhe", options=list(NIVEIS_MAPA), value='Cidade')
+                with col2:
+                    peso = st.radio("Peso", options=['impressions', 'uniques'], horizontal=True)
+
+                # Agregação no servidor: só as células do nível escolhido vão para o navegador
+                tamanho_celula, zoom = NIVEIS_MAPA[nivel]
+                dados = dados_mapa(final, chave_dataset, tamanho_celula, peso)
+                if tamanho_celula is None and len(final) > LIMITE_PONTOS_MAPA:
+                    st.info(f"Mostrando os {LIMITE_PONTOS_MAPA} pontos com maior '{peso}' de {len(final)}.")
+                elif tamanho_celula is not None:
+                    st.caption(f"{len(dados)} células de {tamanho_celula:g}° agregando {len(final)} pontos.")
+                if not dados.empty:
+                    st.pydeck_chart(mapa_pydeck(dados, tamanho_celula, zoom))
+            else:
+                aguardar_etapa('juncao')
         with tab4:
-                st.header('Métricas por cada dia')
-                st.write(periodo_info)
-                df_data = df[((df['class'].isnull()) & 
-                                ~(df['location_id'].isnull()) & 
-                                (df['gender_group'].isnull()) & 
-                                (df['country'].isnull()) & 
-                                ~(df['date'].isnull()) & 
-                                (df['age_group'].isnull()) & 
-                                (df['impression_hour'].isnull()) & 
-                                (df['num_total_impressions'].isnull()) & 
-                                (df['home'].isnull()))]
-                
-                # Tratar o dataframe de data
-                df_data_filtrado = df_data[['location_id', 'impressions', 'uniques', 'date']]
-
-                # Transformar em data
-                df_data_filtrado['date'] = pd.to_datetime(df_data_filtrado['date'])
-                df_data_filtrado = df_data_filtrado.sort_values('date')
-
-                # Aplica a função na coluna 'location_id'
-                df_data_filtrado['location_id'] = df_data_filtrado['location_id'].apply(process_location_id)
-
-                # Mostra o dataframe
-                st.dataframe(df_data_filtrado)
-
-                # Criar buffers para arquivos
-                output_csv = BytesIO()
-                output_excel = BytesIO()
-
-                # Definir o nome do arquivo processado CSV
-                processed_filename_csv = f"{original_filename}_processado_{datetime.now().strftime('%Y-%m-%d')} por data.csv"
-
-                # Definir o nome do arquivo processado EXCEL
-                processed_filename_xlsx = f"{original_filename}_processado_{datetime.now().strftime('%Y-%m-%d')} por data.xlsx"
-
-                # Criar o CSV
-                df_data_filtrado.to_csv(output_csv, index=False)
-                output_csv.seek(0)
-
-                # Criar o Excel
-                with pd.ExcelWriter(output_excel, engine='openpyxl') as writer:
-                    df_data_filtrado.to_excel(writer, index=False, sheet_name='Dados Processados')
-                output_excel.seek(0)
-
-                st.download_button(
-                    label="📁 Baixar CSV Processado",
-                    data=output_csv,
-                    file_name=processed_filename_csv,
-                    mime="text/csv"
-                )
+            if 'df_data_filtrado' in resultado:
+                    st.header('Métricas por cada dia')
+                    st.write(periodo_info)
 
-                st.download_button(
-                    label="📁 Baixar Excel Processado",
-                    data=output_excel,
-                    file_name=processed_filename_xlsx,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )                       
+                    # Mostra o dataframe (já preparado e em cache), uma página por vez
+                    tabela_paginada(df_data_filtrado, chave_dataset, 'data')
+
+                    # Nome base do arquivo processado
+                    processed_filename = f"{original_filename}_processado_{datetime.now().strftime('%Y-%m-%d')} por data"
+
+                    # Downloads gerados só quando solicitados
+                    botoes_download(df_data_filtrado, chave_dataset, 'data', processed_filename)
+            else:
+                aguardar_etapa('tabela_datas')
         with tab5:
-            # Supondo que os dados já estejam carregados e processados, como mostrado anteriormente.
-            st.header("Gráficos")
-
-            # Criação de colunas para exibir gráficos lado a lado
-            col1, col2 = st.columns(2)
-
-            # Gráfico de Classe Social
-            with col1:
-                st.subheader("Distribuição por Classe Social")
-                classe_df = pd.DataFrame(list(porcentagem_por_classe.items()), columns=['Classe Social', 'Porcentagem'])
-                fig_classe = px.bar(classe_df, x='Classe Social', y='Porcentagem',
-                                labels={'Porcentagem': 'Porcentagem (%)'},
-                                title="Distribuição de Porcentagem por Classe Social")
-                fig_classe.update_layout(height=300, width=400)  # Ajusta o tamanho do gráfico
-                st.plotly_chart(fig_classe, use_container_width=True)
-
-            # Gráfico de Faixa Etária
-            with col1:
-                st.subheader("Distribuição por Faixa Etária")
-                idade_df = pd.DataFrame(list(porcentagem_por_idade.items()), columns=['Faixa Etária', 'Porcentagem'])
-                idade_df['Faixa Etária'] = idade_df['Faixa Etária'].map(faixas_etarias)
-                fig_idade = px.bar(idade_df, x='Faixa Etária', y='Porcentagem',
-                                labels={'Porcentagem': 'Porcentagem (%)'},
-                                title="Distribuição de Porcentagem por Faixa Etária")
-                fig_idade.update_layout(height=300, width=400)  # Ajusta o tamanho do gráfico
-                st.plotly_chart(fig_idade, use_container_width=True)
-
-            # Gráfico de Gênero como pizza
-            with col2:
-                st.subheader("Distribuição por Gênero")
-                genero_df = pd.DataFrame(list(porcentagem_por_genero.items()), columns=['Gênero', 'Porcentagem'])
-                genero_df['Gênero'] = genero_df['Gênero'].map({'F': 'Feminino', 'M': 'Masculino'})
-                fig_genero = px.pie(genero_df, names='Gênero', values='Porcentagem',
-                                title="Distribuição de Porcentagem por Gênero",
-                                labels={'Porcentagem': 'Porcentagem (%)'})
-                fig_genero.update_layout(height=300, width=400)  # Ajusta o tamanho do gráfico
-                st.plotly_chart(fig_genero, use_container_width=True)
-
-            # Gráfico da Distribuição de 'uniques' por Frequência
-            with col2:
-                st.subheader("Distribuição de 'uniques' por Frequência")
-                fig_uniques = px.histogram(df, x='uniques', nbins=30, title="Distribuição de 'uniques'",
-                                        labels={'uniques': "Número de 'uniques'"})
-                fig_uniques.update_layout(height=300, width=400)  # Ajusta o tamanho do gráfico
-                st.plotly_chart(fig_uniques, use_container_width=True)
-
-            # Gráfico combinado de Impressions e Uniques por Data com marcadores
-            st.subheader("Impressions e Uniques por Data")
-            df_impressions = df_data_filtrado.groupby('date')['impressions'].sum().reset_index()
-            df_uniques = df_data_filtrado.groupby('date')['uniques'].sum().reset_index()
-            
-            fig_combined = go.Figure()
-
-            # Linha para Impressions
-            fig_combined.add_trace(go.Scatter(x=df_impressions['date'], y=df_impressions['impressions'],
-                                            mode='lines+markers',
-                                            name='Impressions',
-                                            line=dict(color='blue'),
-                                            marker=dict(symbol='circle', color='blue')))
-
-            # Linha para Uniques
-            fig_combined.add_trace(go.Scatter(x=df_uniques['date'], y=df_uniques['uniques'],
-                                            mode='lines+markers',
-                                            name='Uniques',
-                                            line=dict(color='red'),
-                                            marker=dict(symbol='circle', color='red')))
+            if 'graficos' in resultado:
+                # Supondo que os dados já estejam carregados e processados, como mostrado anteriormente.
+                st.header("Gráficos")
+
+                # Plotly só é carregado quando os gráficos são mostrados pela primeira vez
+                px = importar('plotly.express')
+                go = importar('plotly.graph_objects')
+
+                # Criação de colunas para exibir gráficos lado a lado
+                col1, col2 = st.columns(2)
+
+                # Gráfico de Classe Social
+                with col1:
+                    st.subheader("Distribuição por Classe Social")
+                    fig_classe = px.bar(graficos['classe'], x='Classe Social', y='Porcentagem',
+                                    labels={'Porcentagem': 'Porcentagem (%)'},
+                                    title="Distribuição de Porcentagem por Classe Social")
+                    fig_classe.update_layout(height=300, width=400)  # Ajusta o tamanho do gráfico
+                    st.plotly_chart(fig_classe, use_container_width=True)
+
+                # Gráfico de Faixa Etária
+                with col1:
+                    st.subheader("Distribuição por Faixa Etária")
+                    fig_idade = px.bar(graficos['idade'], x='Faixa Etária', y='Porcentagem',
+                                    labels={'Porcentagem': 'Porcentagem (%)'},
+                                    title="Distribuição de Porcentagem por Faixa Etária")
+                    fig_idade.update_layout(height=300, width=400)  # Ajusta o tamanho do gráfico
+                    st.plotly_chart(fig_idade, use_container_width=True)
+
+                # Gráfico de Gênero como pizza
+                with col2:
+                    st.subheader("Distribuição por Gênero")
+                    fig_genero = px.pie(graficos['genero'], names='Gênero', values='Porcentagem',
+                                    title="Distribuição de Porcentagem por Gênero",
+                                    labels={'Porcentagem': 'Porcentagem (%)'})
+                    fig_genero.update_layout(height=300, width=400)  # Ajusta o tamanho do gráfico
+                    st.plotly_chart(fig_genero, use_container_width=True)
+
+                # Gráfico da Distribuição de 'uniques' por Frequência
+                with col2:
+                    st.subheader("Distribuição de 'uniques' por Frequência")
+                    # Histograma já calculado no servidor: só as contagens vão para o navegador
+                    histograma = graficos['histograma_uniques']
+                    fig_uniques = px.bar(histograma, x='uniques', y='contagem', title="Distribuição de 'uniques'",
+                                         hover_data={'inicio': True, 'fim': True},
+                                         labels={'uniques': "Número de 'uniques'", 'contagem': 'count'})
+                    fig_uniques.update_layout(height=300, width=400, bargap=0)  # Ajusta o tamanho do gráfico
+                    st.plotly_chart(fig_uniques, use_container_width=True)
+
+                # Gráfico combinado de Impressions e Uniques por Data com marcadores
+                st.subheader("Impressions e Uniques por Data")
+                agrupamento = st.radio("Agrupar por", ["Dia", "Semana"], horizontal=True, key='agrupamento_datas')
+                serie, completa = ((graficos['por_data'], resultado['rollups']['diario']) if agrupamento == "Dia"
+                                   else (graficos['por_semana'], resultado['rollups']['semanal']))
+                if len(serie) < len(completa):
+                    st.caption(f"Série reduzida a {len(serie)} pontos (de {len(completa)}), mantendo mínimos e máximos.")
+                df_impressions = df_uniques = serie
+
+                fig_combined = go.Figure()
+
+                # Linha para Impressions
+                fig_combined.add_trace(go.Scatter(x=df_impressions['date'], y=df_impressions['impressions'],
+                                                mode='lines+markers',
+                                                name='Impressions',
+                                                line=dict(color='blue'),
+                                                marker=dict(symbol='circle', color='blue')))
+
+                # Linha para Uniques
+                fig_combined.add_trace(go.Scatter(x=df_uniques['date'], y=df_uniques['uniques'],
+                                                mode='lines+markers',
+                                                name='Uniques',
+                                                line=dict(color='red'),
+                                                marker=dict(symbol='circle', color='red')))
             
-            fig_combined.update_layout(title="Impressions e Uniques por Data",
-                                    xaxis_title="Data",
-                                    yaxis_title="Valores",
-                                    legend_title="Legenda",
-                                    template='plotly_white',
-                                    height=400, width=800)  # Ajusta o tamanho do gráfico
-
-            st.plotly_chart(fig_combined, use_container_width=True)
+                fig_combined.update_layout(title="Impressions e Uniques por Data",
+                                        xaxis_title="Data",
+                                        yaxis_title="Valores",
+                                        legend_title="Legenda",
+                                        template='plotly_white',
+                                        height=400, width=800)  # Ajusta o tamanho do gráfico
+
+                st.plotly_chart(fig_combined, use_container_width=True)
+            else:
+                aguardar_etapa('graficos')
         with tab6:
             # Função principal
             def main():
@@ -474,117 +762,109 @@ if uploaded_file is not None:
                 # Verifica se o dicionário foi fornecido
                 if dict_input:
                     try:
-                        # Tenta converter a entrada para um dicionário Python
-                        response = eval(dict_input)
+                        # Resposta lida como JSON/literal e cubo idade × gênero × classe, uma vez por texto
+                        cubo = cubo_resposta(dict_input)
 
                         # Validação básica do dicionário
-                        if 'data' not in response or \
-                        'impressions' not in response['data'] or \
-                        'unique_devices' not in response['data'] or \
-                        'uniques_by_age_and_gender' not in response['data'] or \
-                        'uniques_by_social_class' not in response['data']:
+                        if cubo is None:
                             st.error("O dicionário fornecido não possui as chaves esperadas. Verifique a estrutura do dicionário.")
                         else:
-                            # Extração de dados do dicionário
-                            try:
-                                impactos = response['data']['impressions']['data'][0]['total_trips']
-                                alcance_geral = response['data']['unique_devices']['data'][0]['uniques']
-                                data = response['data']['uniques_by_age_and_gender']['data']
-                                df = pd.DataFrame(data)
-
-                                # Exibir os dados extraídos
-                                st.subheader("Dados Extraídos:")
-                                st.write(f"Impactos: {round(impactos)}")
-                                st.write(f"Alcance Geral: {round(alcance_geral)}")
-
-                                # Opções de filtros
-                                todas_idades = ['Todos', '18-19', '20-29', '30-39', '40-49', '50-59', '60-69', '70-79', '80+']
-                                todos_generos = ['AS', 'F', 'M']
-                                todas_classes = ['A', 'B1', 'B2', 'C1', 'C2', 'DE']
-
-                                # Filtros dinâmicos com a opção de "Selecionar Todos"
-                                st.subheader("Filtros")
-                                
-                                # Filtro por idade
-                                age_filter = st.multiselect("Selecione as idades", options=todas_idades)
-                                if 'Todos' in age_filter:
-                                    age_filter = todas_idades[1:]  # Exclui o 'Todos' da lista
-
-                                # Filtro por gênero
-                                gender_filter = st.multiselect("Selecione o gênero", options=todos_generos)
-                                if 'AS' in gender_filter:
-                                    gender_filter = todos_generos[1:]  # Exclui o 'Todos' da lista
-
-                                # Filtro por classe social
-                                class_filter = st.multiselect("Selecione as classes sociais", options=todas_classes)
-                                if 'Todos' in class_filter:
-                                    class_filter = todas_classes[1:]  # Exclui o 'Todos' da lista
-
-                                # Aplicando os filtros
-                                df_filtered = df[(df['age'].isin(age_filter)) & (df['gender'].isin(gender_filter))]
-
-                                total_idades = df_filtered.uniques.sum()
-                                total_genero = df[~(df['gender'] == 'U') & (df['age'] != 'Unknown')].uniques.sum()
-                                total_generoidade = df[(df['gender'] != 'U') & (df['age'] != 'Unknown')].uniques.sum()
-
-                                # Calculando métricas de gênero, idade e classes
-                                final_genero = total_genero / total_generoidade
-                                final_idade = total_idades / total_generoidade
-
-                                # Classe social
-                                data_class = response['data']['uniques_by_social_class']['data']
-                                df_classe = pd.DataFrame(data_class)
-                                total_classes = df_classe[df_classe['social_class'].isin(todas_classes[1:])].uniques.sum()  # Exclui 'Todos'
-                                total_filtro_classes = df_classe[df_classe['social_class'].isin(class_filter)].uniques.sum()
-                                final_classes = total_filtro_classes / total_classes
-
-                                # Cálculo final
-                                comp = final_genero * final_idade * final_classes
-                                alcance_target = comp * alcance_geral
-                                impactos_target = comp * impactos
-
-                                # Cálculo final
-                                comp = final_genero * final_idade * final_classes
-                                alcance_target = comp * alcance_geral
-                                impactos_target = comp * impactos
-
-                                # Exibir resultados finais
-                                st.subheader("Resultados Finais")
-                                st.write(f"Composicao: {round(comp, 2)}")
-                                st.write(f"Alcance Target: {round(alcance_target)}")
-                                st.write(f"Impactos Target: {round(impactos_target)}")
-
-                            except KeyError as e:
-                                st.error(f"Erro ao processar o dicionário: chave ausente {e}")
-
+                            # Exibir os dados extraídos
+                            st.subheader("Dados Extraídos:")
+                            st.write(f"Impactos: {round(cubo['impactos'])}")
+                            st.write(f"Alcance Geral: {round(cubo['alcance_geral'])}")
+
+                            # Filtros dinâmicos com a opção de "Selecionar Todos"
+                            st.subheader("Filtros")
+                            age_filter = st.multiselect("Selecione as idades", options=TODAS_IDADES)
+                            gender_filter = st.multiselect("Selecione o gênero", options=TODOS_GENEROS)
+                            class_filter = st.multiselect("Selecione as classes sociais", options=TODAS_CLASSES)
+
+                            # Composição lida do cubo para os filtros escolhidos
+                            alvo = calcular_alvo(cubo, age_filter, gender_filter, class_filter)
+
+                            # Exibir resultados finais
+                            st.subheader("Resultados Finais")
+                            st.write(f"Composicao: {round(alvo['composicao'], 2)}")
+                            st.write(f"Alcance Target: {round(alvo['alcance_target'])}")
+                            st.write(f"Impactos Target: {round(alvo['impactos_target'])}")
+
+                    except KeyError as e:
+                        st.error(f"Erro ao processar o dicionário: chave ausente {e}")
                     except SyntaxError:
                         st.error("O texto fornecido não é um dicionário Python válido. Verifique a formatação.")
                     except Exception as e:
                         st.error(f"Erro inesperado: {e}")
-                        
+
+                # Vários públicos em várias respostas de uma vez
+                st.subheader("Cálculo em lote")
+                respostas_lote = st.file_uploader("Respostas da API (um arquivo por resposta)", type=["json", "txt"],
+                                                  accept_multiple_files=True, key='respostas_lote')
+                audiencias_input = st.text_area(
+                    "Públicos (JSON)", height=150, key='audiencias_lote',
+                    placeholder='[{"nome": "Mulheres 20-39 AB", "idades": ["20-29", "30-39"], '
+                                '"generos": ["F"], "classes": ["A", "B1", "B2"]}]')
+                if respostas_lote and audiencias_input:
+                    try:
+                        cubos = {}
+                        for arquivo in respostas_lote:
+                            cubo = cubo_resposta(arquivo.getvalue().decode('utf-8'))
+                            if cubo is None:
+                                st.error(f"{arquivo.name} não possui as chaves esperadas.")
+                                continue
+                            cubos[os.path.splitext(arquivo.name)[0]] = cubo
+                        if cubos:
+                            alvos = calcular_alvos(cubos, interpretar_audiencias(audiencias_input))
+                            st.dataframe(alvos, width='stretch')
+                            chave_lote = hashlib.md5(
+                                audiencias_input.encode() + b''.join(arquivo.getvalue() for arquivo in respostas_lote)
+                            ).hexdigest()
+                            botoes_download(alvos, chave_lote, 'alvos', f"alvos_{datetime.now().strftime('%Y-%m-%d')}")
+                    except KeyError as e:
+                        st.error(f"Erro ao processar o lote: chave ausente {e}")
+                    except (SyntaxError, ValueError) as e:
+                        st.error(f"Erro ao ler o lote: {e}")
+
             # Rodando o aplicativo Streamlit
             if __name__ == "__main__":
                 main()
         with tab7:
-                        # Função para mostrar o mapa Kepler no Streamlit
-            def show_kepler_map(final):
-                # Crie uma instância do KeplerGl e adicione o dataframe
-                mapa = KeplerGl(height=400)
-                mapa.add_data(data=final, name="Dados Geográficos")
-
-                # Salve a configuração do mapa em um arquivo JSON temporário
-                mapa.save_to_html(file_name='kepler_map.html', read_only=False)
-
-                # Abrir o arquivo HTML gerado e embutir no streamlit
-                with open('kepler_map.html', 'r') as f:
-                    html_code = f.read()
-
-                # Exibir o iframe com o mapa
-                st.components.v1.html(html_code, height=600)
-
-            # Criar e exibir o mapa
-            if st.button('Gerar Mapa'):
-                st.subheader("Mapa Interativo:")
-                show_kepler_map(final)
+            if 'final' in resultado:
+                # Função para mostrar o mapa Kepler no Streamlit
+                def show_kepler_map(final):
+                    if len(final) > LIMITE_PONTOS_KEPLER:
+                        st.info(f"{len(final)} pontos: o mapa mostra os dados agregados em grade "
+                                f"(limite de {LIMITE_PONTOS_KEPLER} pontos).")
+                    html_code = acompanhar_kepler(resultado, chave_dataset, tarefa is None)
+                    if html_code is None:
+                        st.info("Gerando mapa...")
+                        return False
+
+                    # Exibir o iframe com o mapa
+                    st.components.v1.html(html_code, height=600)
+                    return True
+
+                # Criar e exibir o mapa (o pedido vale para os reruns seguintes,
+                # enquanto o HTML é gerado em segundo plano)
+                mapas_pedidos = st.session_state.setdefault('mapas_kepler', set())
+                if st.button('Gerar Mapa'):
+                    mapas_pedidos.add(chave_dataset)
+                if chave_dataset in mapas_pedidos:
+                    st.subheader("Mapa Interativo:")
+                    if not show_kepler_map(final):
+                        em_andamento = True
+            else:
+                aguardar_etapa('juncao')
+
+        painel_memoria(chave_dataset)
+        painel_diagnostico(chave_dataset)
+
+        # Enquanto alguma etapa roda em segundo plano, a página é
+        # atualizada periodicamente para mostrar o que já terminou
+        if em_andamento:
+            time.sleep(INTERVALO_ATUALIZACAO)
+            st.rerun()
     except Exception as e:
         st.error(f"Ocorreu um erro ao processar o arquivo: {e}")
+else:
+    liberar_processamento()
@@ -0,0 +1,216 @@
+# Armazenamento em disco das campanhas já processadas.
+#
+# Cada resultado do pipeline fica em um diretório com o nome da chave do
+# dataset (hash do conteúdo do arquivo + versão do cadastro): as tabelas em
+# Parquet e um manifesto JSON com o nome do arquivo, as datas de
+# processamento e de último acesso, o tamanho e os valores pequenos (período,
+# totais, porcentagens). Reabrir uma campanha lê só esses arquivos, sem
+# passar pelo arquivo original. Quando o total passa do limite, as campanhas
+# acessadas há mais tempo são apagadas.
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from estatisticas import EsbocoEstatisticas
+from processamento import COLUNAS_METRICAS, FAIXAS_ETARIAS
+
+# Diretório do armazenamento e limite de espaço ocupado (MB)
+DIR_ARMAZENAMENTO = os.environ.get('DIR_ARMAZENAMENTO', 'campanhas_processadas')
+LIMITE_ARMAZENAMENTO_MB = int(os.environ.get('LIMITE_ARMAZENAMENTO_MB', 2048))
+
+MANIFESTO = 'manifesto.json'
+
+# Partes do resultado que não são guardadas (refeitas sob demanda)
+CHAVES_NAO_ARMAZENADAS = {'kepler_html', 'erro_armazenamento'}
+
+def caminho_campanha(chave, raiz=DIR_ARMAZENAMENTO):
+    return os.path.join(raiz, chave)
+
+# Indica se a campanha está guardada (só verifica o manifesto, sem ler nada)
+def campanha_guardada(chave, raiz=DIR_ARMAZENAMENTO):
+    return os.path.exists(os.path.join(caminho_campanha(chave, raiz), MANIFESTO))
+
+# Converte um valor do resultado para o manifesto. DataFrames e Series viram
+# arquivos Parquet (um arquivo por objeto, mesmo se referenciado duas vezes);
+# dicionários guardam a lista de pares para manter o tipo das chaves
+def codificar(valor, pasta, nome, gravados):
+    if isinstance(valor, (pd.DataFrame, pd.Series)):
+        if id(valor) not in gravados:
+            arquivo = f"{nome}.parquet"
+            tabela = valor if isinstance(valor, pd.DataFrame) else valor.to_frame(name=valor.name or 'valor')
+            tabela.to_parquet(os.path.join(pasta, arquivo))
+            gravados[id(valor)] = arquivo
+        chave = 'tabela' if isinstance(valor, pd.DataFrame) else 'serie'
+        return {chave: gravados[id(valor)]}
+    if isinstance(valor, dict):
+        return {'dict': [[codificar_escalar(chave), codificar(item, pasta, f"{nome}.{chave}", gravados)]
+                         for chave, item in valor.items() if chave not in CHAVES_NAO_ARMAZENADAS]}
+    return {'valor': codificar_escalar(valor)}
+
+def codificar_escalar(valor):
+    return valor.item() if isinstance(valor, np.generic) else valor
+
+def decodificar(codigo, pasta, lidos):
+    if 'tabela' in codigo or 'serie' in codigo:
+        arquivo = codigo.get('tabela', codigo.get('serie'))
+        if arquivo not in lidos:
+            lidos[arquivo] = pd.read_parquet(os.path.join(pasta, arquivo))
+        tabela = lidos[arquivo]
+        return tabela if 'tabela' in codigo else tabela.iloc[:, 0]
+    if 'dict' in codigo:
+        return {chave: decodificar(item, pasta, lidos) for chave, item in codigo['dict']}
+    return codigo['valor']
+
+def tamanho_pasta(pasta):
+    return sum(entrada.stat().st_size for entrada in os.scandir(pasta) if entrada.is_file())
+
+def ler_manifesto(pasta):
+    with open(os.path.join(pasta, MANIFESTO), encoding='utf-8') as f:
+        return json.load(f)
+
+def gravar_manifesto(pasta, manifesto):
+    temporario = os.path.join(pasta, f"{MANIFESTO}.{uuid.uuid4().hex}")
+    with open(temporario, 'w', encoding='utf-8') as f:
+        json.dump(manifesto, f, ensure_ascii=False)
+    os.replace(temporario, os.path.join(pasta, MANIFESTO))
+
+# Grava um resultado do pipeline. A gravação é feita em um diretório
+# temporário e renomeada no fim, então uma campanha incompleta nunca aparece
+def salvar_resultado(chave, resultado, nome, raiz=DIR_ARMAZENAMENTO, limite_mb=LIMITE_ARMAZENAMENTO_MB):
+    destino = caminho_campanha(chave, raiz)
+    if os.path.isdir(destino):
+        return
+    os.makedirs(raiz, exist_ok=True)
+    temporario = os.path.join(raiz, f".{chave}.{uuid.uuid4().hex}")
+    os.makedirs(temporario)
+    try:
+        agora = datetime.now().isoformat(timespec='seconds')
+        manifesto = {
+            'chave': chave,
+            'nome': nome,
+            'processado_em': agora,
+            'ultimo_acesso': agora,
+            'resultado': codificar(resultado, temporario, 'resultado', {}),
+        }
+        manifesto['tamanho_bytes'] = tamanho_pasta(temporario)
+        gravar_manifesto(temporario, manifesto)
+        os.rename(temporario, destino)
+    except OSError:
+        shutil.rmtree(temporario, ignore_errors=True)
+        # Outro processo gravou a mesma campanha ao mesmo tempo
+        if not os.path.isdir(destino):
+            raise
+    liberar_espaco(raiz, limite_mb * 1024 * 1024, manter=chave)
+
+# Lê uma campanha guardada (ou None se não existe) e marca o acesso
+def carregar_resultado(chave, raiz=DIR_ARMAZENAMENTO):
+    pasta = caminho_campanha(chave, raiz)
+    try:
+        manifesto = ler_manifesto(pasta)
+        resultado = decodificar(manifesto['resultado'], pasta, {})
+    except (OSError, ValueError, KeyError):
+        return None
+    manifesto['ultimo_acesso'] = datetime.now().isoformat(timespec='seconds')
+    try:
+        gravar_manifesto(pasta, manifesto)
+    except OSError:
+        pass
+    return resultado
+
+# Manifestos das campanhas guardadas (sem o resultado), mais recentes primeiro
+def listar_campanhas(raiz=DIR_ARMAZENAMENTO):
+    if not os.path.isdir(raiz):
+        return []
+    campanhas = []
+    for entrada in os.scandir(raiz):
+        if not entrada.is_dir() or entrada.name.startswith('.'):
+            continue
+        try:
+            manifesto = ler_manifesto(entrada.path)
+        except (OSError, ValueError):
+            continue
+        manifesto.pop('resultado', None)
+        campanhas.append(manifesto)
+    return sorted(campanhas, key=lambda manifesto: manifesto['processado_em'], reverse=True)
+
+# Apaga as campanhas acessadas há mais tempo até o total caber no limite
+def liberar_espaco(raiz, limite_bytes, manter=None):
+    campanhas = sorted(listar_campanhas(raiz), key=lambda manifesto: manifesto['ultimo_acesso'])
+    total = sum(manifesto['tamanho_bytes'] for manifesto in campanhas)
+    for manifesto in campanhas:
+        if total <= limite_bytes:
+            break
+        if manifesto['chave'] == manter:
+            continue
+        shutil.rmtree(caminho_campanha(manifesto['chave'], raiz), ignore_errors=True)
+        total -= manifesto['tamanho_bytes']
+
+# Nome da campanha nas comparações; arquivos com o mesmo nome são
+# diferenciados pela data de processamento
+def rotulo_campanha(manifesto, usados):
+    rotulo = manifesto['nome']
+    if rotulo in usados:
+        rotulo = f"{rotulo} ({manifesto['processado_em']})"
+    return rotulo
+
+# Comparação entre campanhas guardadas a partir dos manifestos e das séries
+# diárias, sem reler os arquivos originais. Retorna uma linha de indicadores
+# por campanha e as séries diárias empilhadas (coluna 'campanha')
+def comparar_campanhas(chaves, raiz=DIR_ARMAZENAMENTO):
+    indicadores = []
+    series = []
+    for chave in chaves:
+        pasta = caminho_campanha(chave, raiz)
+        manifesto = ler_manifesto(pasta)
+        itens = dict(manifesto['resultado']['dict'])
+        resumo = decodificar(itens['resumo'], pasta, {})
+
+        rotulo = rotulo_campanha(manifesto, [linha['campanha'] for linha in indicadores])
+        linha = {
+            'campanha': rotulo,
+            'periodo': itens['periodo_info']['valor'],
+            'pontos': resumo['quantidade_location_id'],
+            'alcance': resumo['total_alcance'],
+            'impactos': resumo['total_impactos'],
+        }
+        for classe, porcentagem in resumo['porcentagem_por_classe'].items():
+            linha[f"% classe {classe}"] = porcentagem
+        for genero, porcentagem in resumo['porcentagem_por_genero'].items():
+            linha[f"% {genero}"] = porcentagem
+        for idade, porcentagem in resumo['porcentagem_por_idade'].items():
+            linha[f"% {FAIXAS_ETARIAS.get(idade, idade)}"] = porcentagem
+        indicadores.append(linha)
+
+        diario = decodificar(dict(itens['rollups']['dict'])['diario'], pasta, {})
+        series.append(diario.assign(campanha=rotulo))
+    return pd.DataFrame(indicadores), pd.concat(series, ignore_index=True) if series else pd.DataFrame()
+
+# Estatísticas descritivas das métricas por ponto de cada campanha e de todas
+# juntas, a partir dos esboços guardados no resumo (só o manifesto é lido).
+# Campanhas guardadas antes dos esboços ficam de fora
+def distribuicao_campanhas(chaves, raiz=DIR_ARMAZENAMENTO):
+    linhas = []
+    usados = []
+    totais = {coluna: EsbocoEstatisticas() for coluna in COLUNAS_METRICAS}
+    for chave in chaves:
+        manifesto = ler_manifesto(caminho_campanha(chave, raiz))
+        itens = dict(manifesto['resultado']['dict'])
+        resumo = dict(itens['resumo']['dict'])
+        if 'estatisticas' not in resumo:
+            continue
+        rotulo = rotulo_campanha(manifesto, usados)
+        usados.append(rotulo)
+        for coluna, dados in decodificar(resumo['estatisticas'], None, {}).items():
+            esboco = EsbocoEstatisticas.de_dict(dados)
+            totais[coluna].juntar(esboco)
+            linhas.append({'campanha': rotulo, 'metrica': coluna, **esboco.descrever()})
+    if len(usados) > 1:
+        for coluna, esboco in totais.items():
+            if esboco.contagem:
+                linhas.append({'campanha': 'Todas', 'metrica': coluna, **esboco.descrever()})
+    return pd.DataFrame(linhas)
@@ -0,0 +1,99 @@
+# Benchmark do pipeline de processamento com dados sintéticos.
+#
+# Mede tempo e pico de memória residente de cada etapa (cadastro, leitura, filtros e
+# junção, normalização do location_id, agregados da aba de estatísticas,
+# fatia por data e exportações) em vários tamanhos, grava os resultados em
+# JSON e compara com uma execução anterior para acusar regressões.
+#
+# Uso:
+#     python benchmark.py --tamanhos 10k 1M 10M [--formato parquet]
+#                         [--saida resultados.json] [--comparar base.json]
+import argparse
+import tempfile
+import time
+
+from gerador_dados import gravar_dados, interpretar_tamanho
+from instrumentacao import MonitorMemoria
+from processamento import (calcular_resumo, calcular_rollups, carregar_claro, exportar_bytes,
+                           ler_arquivo, normalizar_location_id, preparar_tabela_datas,
+                           processar_arquivo)
+import regressao
+
+# Limite de linhas de uma planilha do Excel
+LIMITE_LINHAS_EXCEL = 1_048_575
+
+# Executa uma etapa medindo tempo e o acréscimo de memória residente no pico
+def medir(resultados, etapa, funcao, *args):
+    with MonitorMemoria() as monitor:
+        inicio = time.perf_counter()
+        retorno = funcao(*args)
+        duracao = time.perf_counter() - inicio
+    resultados[etapa] = {
+        'segundos': round(duracao, 4),
+        'pico_mb': round((monitor.pico - monitor.inicial) / 2**20, 2),
+        'rss_mb': round(monitor.pico / 2**20, 2),
+    }
+    return retorno
+
+def rodar_tamanho(linhas, pasta, formato, dias, formatos_exportacao):
+    caminho, caminho_claro = gravar_dados(pasta, linhas, dias=dias, formato=formato)
+    resultados = {}
+
+    claro = medir(resultados, 'carregar_claro', carregar_claro, caminho_claro)
+    fatias, _ = medir(resultados, 'leitura', ler_arquivo, caminho, caminho)
+    final, _ = medir(resultados, 'processar_arquivo', processar_arquivo, fatias, claro)
+    medir(resultados, 'normalizar_location_id', normalizar_location_id, fatias['data']['location_id'])
+    final['frequencia'] = round(final['impressions'] / final['uniques'], 2)
+    medir(resultados, 'calcular_resumo', calcular_resumo, fatias, final)
+    df_data = medir(resultados, 'preparar_tabela_datas', preparar_tabela_datas, fatias)
+    medir(resultados, 'calcular_rollups', calcular_rollups, df_data)
+
+    for formato_exportacao in formatos_exportacao:
+        for nome, df in (('final', final), ('data', df_data)):
+            if formato_exportacao == 'Excel' and len(df) > LIMITE_LINHAS_EXCEL:
+                continue
+            medir(resultados, f'exportar_{formato_exportacao.lower()}_{nome}', exportar_bytes, df, formato_exportacao)
+
+    return {'linhas': linhas, 'linhas_final': len(final), 'linhas_data': len(df_data), 'etapas': resultados}
+
+# Tempo de cada etapa em cada tamanho, para comparar com uma execução anterior
+def tempos_etapas(resultado):
+    return {f"{tamanho} {etapa}": medida['segundos']
+            for tamanho, dados in resultado.get('tamanhos', {}).items()
+            for etapa, medida in dados['etapas'].items()}
+
+def imprimir_tabela(resultado):
+    for tamanho, dados in resultado['tamanhos'].items():
+        print(f"\n== {tamanho} linhas ({dados['linhas_final']} pontos, {dados['linhas_data']} linhas por data)")
+        print(f"{'etapa':<32}{'segundos':>10}{'pico MB':>10}{'RSS MB':>10}")
+        for etapa, medida in dados['etapas'].items():
+            print(f"{etapa:<32}{medida['segundos']:>10.3f}{medida['pico_mb']:>10.1f}{medida['rss_mb']:>10.1f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark do pipeline com dados sintéticos.')
+    parser.add_argument('--tamanhos', nargs='+', default=['10k', '1M', '10M'])
+    parser.add_argument('--dias', type=int, default=30)
+    parser.add_argument('--formato', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--exportacoes', nargs='*', default=['CSV', 'Excel', 'Parquet'])
+    parser.add_argument('--dados', default=None, help='Diretório para os dados gerados (padrão: temporário)')
+    parser.add_argument('--saida', default=None, help='Arquivo JSON com os resultados')
+    parser.add_argument('--comparar', default=None, help='JSON de uma execução anterior para comparação')
+    parser.add_argument('--tolerancia', type=float, default=regressao.TOLERANCIA)
+    args = parser.parse_args(argv)
+
+    resultado = {
+        **regressao.iniciar(),
+        'formato': args.formato,
+        'tamanhos': {},
+    }
+    with tempfile.TemporaryDirectory() as temporario:
+        pasta = args.dados or temporario
+        for tamanho in args.tamanhos:
+            linhas = interpretar_tamanho(tamanho)
+            resultado['tamanhos'][tamanho] = rodar_tamanho(linhas, pasta, args.formato, args.dias, args.exportacoes)
+
+    imprimir_tabela(resultado)
+    regressao.concluir(resultado, tempos_etapas, args.saida, args.comparar, args.tolerancia)
+
+if __name__ == '__main__':
+    main()
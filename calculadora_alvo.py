@@ -0,0 +1,168 @@
+# Calculadora de público-alvo a partir da resposta da API de audiência.
+#
+# A resposta (JSON ou dicionário Python colado na aba "Tratamento JSON") é
+# lida sem eval e vira um cubo com a participação de cada combinação
+# idade × gênero × classe social nos uniques. Qualquer filtro de público é
+# respondido somando as células selecionadas do cubo, e o modo em lote
+# calcula alcance e impactos de várias respostas × vários públicos de uma vez.
+#
+# Uso:
+#     python calculadora_alvo.py RESPOSTAS... --audiencias audiencias.json
+#                                [--saida alvos.csv]
+import argparse
+import ast
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Opções dos filtros de público (a primeira entrada de idade e de gênero
+# seleciona todas as outras)
+TODAS_IDADES = ['Todos', '18-19', '20-29', '30-39', '40-49', '50-59', '60-69', '70-79', '80+']
+TODOS_GENEROS = ['AS', 'F', 'M']
+TODAS_CLASSES = ['A', 'B1', 'B2', 'C1', 'C2', 'DE']
+
+# Eixos do cubo
+IDADES_CUBO = TODAS_IDADES[1:]
+GENEROS_CUBO = TODOS_GENEROS[1:]
+CLASSES_CUBO = TODAS_CLASSES
+
+# Classes somadas no denominador da participação por classe. Mantém a conta
+# da calculadora original (todas_classes[1:]), que deixa a classe A de fora
+CLASSES_DENOMINADOR = TODAS_CLASSES[1:]
+
+# Blocos obrigatórios da resposta
+CHAVES_RESPOSTA = ['impressions', 'unique_devices', 'uniques_by_age_and_gender', 'uniques_by_social_class']
+
+# Lê o texto da resposta como JSON ou, se não for JSON, como literal Python
+# (aspas simples, True/None). Nunca executa código
+def interpretar_resposta(texto):
+    try:
+        return json.loads(texto)
+    except json.JSONDecodeError:
+        pass
+    try:
+        return ast.literal_eval(texto.strip())
+    except (ValueError, SyntaxError, MemoryError, RecursionError) as e:
+        raise SyntaxError("O texto fornecido não é um dicionário válido") from e
+
+# Verifica se a resposta tem os blocos usados pela calculadora
+def resposta_valida(response):
+    return (isinstance(response, dict) and isinstance(response.get('data'), dict)
+            and all(chave in response['data'] for chave in CHAVES_RESPOSTA))
+
+# Uniques de uma lista de registros somados pelas chaves informadas, nos eixos do cubo
+def somar_uniques(registros, chaves, eixos):
+    df = pd.DataFrame(registros, columns=chaves + ['uniques'])
+    soma = df.groupby(chaves)['uniques'].sum()
+    if len(chaves) == 1:
+        return soma.reindex(eixos[0], fill_value=0).to_numpy(dtype=float)
+    indice = pd.MultiIndex.from_product(eixos, names=chaves)
+    return soma.reindex(indice, fill_value=0).to_numpy(dtype=float).reshape([len(eixo) for eixo in eixos])
+
+# Cubo idade × gênero × classe de uma resposta. Cada célula é a participação
+# de idade/gênero nos uniques com idade e gênero conhecidos vezes a
+# participação da classe nos uniques das classes de CLASSES_DENOMINADOR
+def montar_cubo(response):
+    dados = response['data']
+    impactos = dados['impressions']['data'][0]['total_trips']
+    alcance_geral = dados['unique_devices']['data'][0]['uniques']
+
+    genero_idade = pd.DataFrame(dados['uniques_by_age_and_gender']['data'])
+    conhecidos = genero_idade[(genero_idade['gender'] != 'U') & (genero_idade['age'] != 'Unknown')]
+    total_generoidade = conhecidos['uniques'].sum()
+    uniques_idade_genero = somar_uniques(conhecidos, ['age', 'gender'], [IDADES_CUBO, GENEROS_CUBO])
+
+    uniques_classe = somar_uniques(dados['uniques_by_social_class']['data'], ['social_class'], [CLASSES_CUBO])
+    total_classes = uniques_classe[np.isin(CLASSES_CUBO, CLASSES_DENOMINADOR)].sum()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        participacao = np.multiply.outer(uniques_idade_genero / total_generoidade, uniques_classe / total_classes)
+
+    return {
+        'impactos': impactos,
+        'alcance_geral': alcance_geral,
+        'cubo': participacao,
+    }
+
+# Expande as opções "Todos" (idade) e "AS" (ambos os sexos) dos filtros
+def expandir_filtros(idades, generos, classes):
+    idades = IDADES_CUBO if TODAS_IDADES[0] in idades else idades
+    generos = GENEROS_CUBO if TODOS_GENEROS[0] in generos else generos
+    return idades, generos, classes
+
+# Máscara booleana das células do cubo selecionadas por um público
+def mascara_publico(idades, generos, classes):
+    idades, generos, classes = expandir_filtros(idades, generos, classes)
+    return np.ix_(np.isin(IDADES_CUBO, list(idades)),
+                  np.isin(GENEROS_CUBO, list(generos)),
+                  np.isin(CLASSES_CUBO, list(classes)))
+
+# Composição, alcance e impactos de um público em uma resposta
+def calcular_alvo(cubo, idades, generos, classes):
+    composicao = cubo['cubo'][mascara_publico(idades, generos, classes)].sum()
+    return {
+        'composicao': composicao,
+        'alcance_target': composicao * cubo['alcance_geral'],
+        'impactos_target': composicao * cubo['impactos'],
+    }
+
+# Alcance e impactos de vários públicos em várias respostas: uma linha por
+# resposta × público. Os cubos são empilhados e cada público vira uma máscara,
+# então todas as composições saem de uma única contração
+def calcular_alvos(cubos, audiencias):
+    nomes_respostas = list(cubos)
+    nomes_publicos = list(audiencias)
+    pilha = np.stack([cubos[nome]['cubo'] for nome in nomes_respostas])
+    mascaras = np.zeros((len(nomes_publicos),) + pilha.shape[1:])
+    for posicao, nome in enumerate(nomes_publicos):
+        publico = audiencias[nome]
+        mascaras[posicao][mascara_publico(publico.get('idades', []), publico.get('generos', []),
+                                          publico.get('classes', []))] = 1
+    composicoes = np.einsum('ragc,pagc->rp', pilha, mascaras)
+
+    alcance = np.array([cubos[nome]['alcance_geral'] for nome in nomes_respostas], dtype=float)
+    impactos = np.array([cubos[nome]['impactos'] for nome in nomes_respostas], dtype=float)
+    return pd.DataFrame({
+        'resposta': np.repeat(nomes_respostas, len(nomes_publicos)),
+        'publico': np.tile(nomes_publicos, len(nomes_respostas)),
+        'composicao': composicoes.ravel(),
+        'alcance_target': (composicoes * alcance[:, None]).ravel(),
+        'impactos_target': (composicoes * impactos[:, None]).ravel(),
+    })
+
+# Públicos em JSON: lista de objetos com "nome", "idades", "generos" e
+# "classes", ou um objeto {nome: {"idades": ..., ...}}
+def interpretar_audiencias(texto):
+    audiencias = interpretar_resposta(texto)
+    if isinstance(audiencias, list) and all(isinstance(publico, dict) for publico in audiencias):
+        audiencias = {publico.get('nome', f"Público {posicao + 1}"): publico
+                      for posicao, publico in enumerate(audiencias)}
+    if not isinstance(audiencias, dict) or not all(isinstance(publico, dict) for publico in audiencias.values()):
+        raise ValueError("Os públicos devem ser uma lista de objetos com idades, generos e classes")
+    return audiencias
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Calcula alcance e impactos de vários públicos em várias respostas.')
+    parser.add_argument('respostas', nargs='+', help='Arquivos com as respostas da API (JSON)')
+    parser.add_argument('--audiencias', required=True, help='Arquivo JSON com os públicos')
+    parser.add_argument('--saida', default='alvos.csv', help='CSV com uma linha por resposta × público')
+    args = parser.parse_args(argv)
+
+    with open(args.audiencias, encoding='utf-8') as f:
+        audiencias = interpretar_audiencias(f.read())
+
+    cubos = {}
+    for caminho in args.respostas:
+        with open(caminho, encoding='utf-8') as f:
+            response = interpretar_resposta(f.read())
+        if not resposta_valida(response):
+            parser.error(f"{caminho} não possui as chaves esperadas")
+        cubos[os.path.splitext(os.path.basename(caminho))[0]] = montar_cubo(response)
+
+    calcular_alvos(cubos, audiencias).to_csv(args.saida, index=False)
+    print(f"{len(cubos)} resposta(s) × {len(audiencias)} público(s). Resultado em {args.saida}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+# Teste de carga do app com várias sessões simultâneas em um único processo.
+#
+# Cada sessão é um AppTest (o app rodando sem navegador) em uma thread
+# própria: abre a página, envia uma exportação sintética e repete as
+# interações das abas (colunas da tabela ponto a ponto, nível do mapa,
+# agrupamento dos gráficos, downloads e mapa Kepler). O relatório traz os
+# percentis de latência de cada interação e o crescimento da memória
+# residente do processo, e pode ser gravado em JSON e comparado com uma
+# execução anterior.
+#
+# Uso:
+#     python carga.py --sessoes 8 [--linhas 100k] [--rodadas 3]
+#                     [--arquivos-distintos] [--saida carga.json]
+#                     [--comparar base.json]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import streamlit
+from streamlit.runtime import Runtime
+from streamlit.testing.v1 import AppTest
+
+from gerador_dados import gerar_claro, gerar_exportacao, interpretar_tamanho
+from instrumentacao import MonitorMemoria, rss_atual
+from processamento import FORMATOS_EXPORTACAO
+import regressao
+
+PASTA_APP = os.path.dirname(os.path.abspath(__file__))
+
+# Percentis de latência do relatório
+PERCENTIS = [50, 90, 95, 99]
+
+# Versão do Streamlit para a qual runtime_compartilhado foi escrito (fixada
+# em requirements-dev.txt, só para o teste de carga): ele troca partes
+# internas do Runtime e do gerenciador de mídia, que podem mudar em outras
+# versões
+VERSAO_STREAMLIT = '1.65.0'
+
+# O AppTest cria um runtime simulado a cada execução e o apaga no fim; com
+# sessões em threads, uma sessão que termina tiraria o runtime das outras no
+# meio da execução. Como no servidor, todas as sessões passam a usar um único
+# runtime (o primeiro criado). Todas as sessões do AppTest têm o mesmo id, e a
+# limpeza de downloads adiados de uma apagaria os das outras: cada sessão
+# descarta os seus (Sessao.executar)
+@contextmanager
+def runtime_compartilhado():
+    originais = {nome: Runtime.__dict__[nome] for nome in ('instance', 'exists')}
+    compartilhado = {}
+    trava = threading.Lock()
+
+    def instancia(cls):
+        if 'runtime' not in compartilhado and cls._instance is not None:
+            with trava:
+                if 'runtime' not in compartilhado:
+                    cls._instance.media_file_mgr._remove_orphaned_deferred_callables = lambda: None
+                    compartilhado['runtime'] = cls._instance
+        if 'runtime' not in compartilhado:
+            raise RuntimeError("Runtime hasn't been created!")
+        return compartilhado['runtime']
+
+    Runtime.instance = classmethod(instancia)
+    Runtime.exists = classmethod(lambda cls: cls._instance is not None or 'runtime' in compartilhado)
+    try:
+        yield
+    finally:
+        for nome, metodo in originais.items():
+            setattr(Runtime, nome, metodo)
+
+# Pasta de trabalho da carga: cadastro sintético com o nome que o app espera
+# e as campanhas processadas em um diretório próprio (sem reaproveitar as do
+# uso normal, o que deixaria os envios instantâneos)
+def preparar_pasta(pasta, linhas, dias):
+    gerar_claro(linhas, dias).to_csv(os.path.join(pasta, 'claro.csv'), index=False, encoding='latin-1')
+    shutil.copy(os.path.join(PASTA_APP, 'eletro.png'), pasta)
+    os.environ['DIR_ARMAZENAMENTO'] = os.path.join(pasta, 'campanhas_processadas')
+
+# Exportações em CSV (bytes): uma só para todas as sessões ou uma por sessão
+def gerar_arquivos(sessoes, linhas, dias, distintos):
+    arquivos = []
+    for semente in range(sessoes if distintos else 1):
+        conteudo = gerar_exportacao(linhas, dias, semente=semente).to_csv(index=False).encode('latin-1')
+        arquivos.append((f"carga_{linhas}_{semente}.csv", conteudo))
+    return arquivos
+
+class Sessao:
+    def __init__(self, numero, arquivo, medicoes, timeout):
+        self.numero = numero
+        self.arquivo = arquivo
+        self.medicoes = medicoes
+        self.app = AppTest.from_file(os.path.join(PASTA_APP, 'app.py'), default_timeout=timeout)
+        self.adiados = []
+
+    # Executa o app uma vez. Os downloads adiados da página anterior desta
+    # sessão são descartados antes, como o servidor faz a cada execução
+    def executar(self):
+        if self.adiados:
+            gerenciador = Runtime.instance().media_file_mgr
+            with gerenciador._lock:
+                for identificador in self.adiados:
+                    gerenciador._deferred_callables.pop(identificador, None)
+        self.app.run()
+        self.adiados = [botao.proto.deferred_file_id for botao in self.app.download_button
+                        if botao.proto.deferred_file_id]
+
+    # Executa uma interação e registra a latência; erros do app (exceções e
+    # st.error) também são registrados
+    def medir(self, interacao, funcao):
+        inicio = time.perf_counter()
+        erro = None
+        try:
+            funcao()
+            erros = [str(e.value) for e in self.app.exception] + [str(e.value) for e in self.app.error]
+            erro = erros[0] if erros else None
+        except Exception as e:
+            erro = f"{type(e).__name__}: {e}"
+        self.medicoes.append({
+            'sessao': self.numero,
+            'interacao': interacao,
+            'segundos': round(time.perf_counter() - inicio, 4),
+            'erro': erro,
+        })
+
+    def abrir(self):
+        self.executar()
+
+    # Envio do arquivo; a execução segue as atualizações da página até o
+    # processamento terminar
+    def enviar(self):
+        nome, conteudo = self.arquivo
+        self.app.file_uploader[0].set_value((nome, conteudo, 'text/csv'))
+        self.executar()
+
+    # Acrescenta ou tira uma coluna da seleção da tabela ponto a ponto
+    def trocar_colunas(self, rodada):
+        seletor = next(m for m in self.app.multiselect if m.label.startswith('Escolha as colunas'))
+        extras = [opcao for opcao in seletor.options if opcao not in seletor.value]
+        valor = seletor.value + extras[:1] if rodada % 2 == 0 and extras else seletor.value[:3]
+        seletor.set_value(valor)
+        self.executar()
+
+    def trocar_nivel_mapa(self, rodada):
+        nivel = self.app.select_slider[0]
+        nivel.set_value(nivel.options[rodada % len(nivel.options)])
+        self.executar()
+
+    def trocar_agrupamento(self):
+        agrupamento = self.app.radio(key='agrupamento_datas')
+        agrupamento.set_value('Semana' if agrupamento.value == 'Dia' else 'Dia')
+        self.executar()
+
+    # Downloads da tabela ponto a ponto: o arquivo é gerado pela função
+    # adiada do botão, como quando o navegador pede o download
+    def baixar(self, extensao):
+        botao = self.app.download_button(key=f"download_ponto_{extensao}")
+        Runtime.instance().media_file_mgr.execute_deferred(botao.proto.deferred_file_id)
+
+    # Pede o mapa Kepler; a execução segue as atualizações até o HTML ficar pronto
+    def abrir_kepler(self):
+        next(botao for botao in self.app.button if botao.label == 'Gerar Mapa').click()
+        self.executar()
+
+    def rodar(self, rodadas, formatos_download, kepler, inicio):
+        inicio.wait()
+        self.medir('abrir', self.abrir)
+        self.medir('enviar', self.enviar)
+        for rodada in range(rodadas):
+            self.medir('colunas', lambda: self.trocar_colunas(rodada))
+            self.medir('mapa', lambda: self.trocar_nivel_mapa(rodada))
+            self.medir('graficos', self.trocar_agrupamento)
+            for formato in formatos_download:
+                extensao = FORMATOS_EXPORTACAO[formato][0]
+                self.medir(f"download_{extensao}", lambda: self.baixar(extensao))
+        if kepler:
+            self.medir('kepler', self.abrir_kepler)
+
+# Percentis de latência por interação
+def resumir_latencias(medicoes):
+    resumo = {}
+    for interacao in dict.fromkeys(medicao['interacao'] for medicao in medicoes):
+        tempos = np.array([medicao['segundos'] for medicao in medicoes if medicao['interacao'] == interacao])
+        resumo[interacao] = {
+            'quantidade': len(tempos),
+            'erros': sum(1 for medicao in medicoes if medicao['interacao'] == interacao and medicao['erro']),
+            **{f"p{percentil}": round(float(np.percentile(tempos, percentil)), 4) for percentil in PERCENTIS},
+            'max': round(float(tempos.max()), 4),
+        }
+    return resumo
+
+def rodar_carga(sessoes, linhas, dias, rodadas, distintos, formatos_download, kepler, timeout):
+    medicoes = []
+    with tempfile.TemporaryDirectory() as pasta:
+        preparar_pasta(pasta, linhas, dias)
+        arquivos = gerar_arquivos(sessoes, linhas, dias, distintos)
+        diretorio_anterior = os.getcwd()
+        os.chdir(pasta)
+        try:
+            participantes = [Sessao(numero, arquivos[numero % len(arquivos)], medicoes, timeout)
+                             for numero in range(sessoes)]
+            inicio = threading.Barrier(sessoes)
+            rss_inicial = rss_atual()
+            comeco = time.perf_counter()
+            with runtime_compartilhado(), MonitorMemoria() as monitor:
+                threads = [threading.Thread(target=sessao.rodar, name=f"sessao-{sessao.numero}",
+                                            args=(rodadas, formatos_download, kepler, inicio))
+                           for sessao in participantes]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            duracao = time.perf_counter() - comeco
+            rss_final = rss_atual()
+        finally:
+            os.chdir(diretorio_anterior)
+
+    return {
+        'sessoes': sessoes,
+        'linhas': linhas,
+        'rodadas': rodadas,
+        'arquivos_distintos': distintos,
+        'segundos': round(duracao, 2),
+        'memoria': {
+            'inicial_mb': round(rss_inicial / 2**20, 1),
+            'pico_mb': round(monitor.pico / 2**20, 1),
+            'final_mb': round(rss_final / 2**20, 1),
+            'crescimento_mb': round((rss_final - rss_inicial) / 2**20, 1),
+            'crescimento_por_sessao_mb': round((rss_final - rss_inicial) / 2**20 / sessoes, 1),
+        },
+        'latencias': resumir_latencias(medicoes),
+        'erros': [medicao for medicao in medicoes if medicao['erro']],
+    }
+
+# p95 de cada interação, para comparar com uma execução anterior
+def tempos_p95(resultado):
+    return {f"{interacao} (p95)": medida['p95'] for interacao, medida in resultado.get('latencias', {}).items()}
+
+def imprimir_relatorio(resultado):
+    memoria = resultado['memoria']
+    print(f"\n== {resultado['sessoes']} sessões, {resultado['linhas']} linhas, {resultado['rodadas']} rodadas "
+          f"({'arquivos distintos' if resultado['arquivos_distintos'] else 'mesmo arquivo'}) "
+          f"em {resultado['segundos']:.1f}s")
+    colunas = ''.join(f"{f'p{percentil}':>9}" for percentil in PERCENTIS)
+    print(f"{'interação':<16}{'qtd':>6}{'erros':>7}{colunas}{'max':>9}")
+    for interacao, medida in resultado['latencias'].items():
+        percentis = ''.join(f"{medida[f'p{percentil}']:>9.3f}" for percentil in PERCENTIS)
+        print(f"{interacao:<16}{medida['quantidade']:>6}{medida['erros']:>7}{percentis}{medida['max']:>9.3f}")
+    print(f"\nMemória residente: {memoria['inicial_mb']:.1f} MB no início, pico de {memoria['pico_mb']:.1f} MB, "
+          f"{memoria['final_mb']:.1f} MB no fim (+{memoria['crescimento_mb']:.1f} MB, "
+          f"{memoria['crescimento_por_sessao_mb']:.1f} MB por sessão)")
+    for erro in resultado['erros'][:10]:
+        print(f"ERRO sessão {erro['sessao']} {erro['interacao']}: {erro['erro']}", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Teste de carga do app com sessões simultâneas.')
+    parser.add_argument('--sessoes', type=int, default=4)
+    parser.add_argument('--linhas', default='100k', help="Tamanho de cada exportação (ex.: 10k, 1M)")
+    parser.add_argument('--dias', type=int, default=30)
+    parser.add_argument('--rodadas', type=int, default=3, help='Repetições das interações das abas por sessão')
+    parser.add_argument('--arquivos-distintos', action='store_true',
+                        help='Uma exportação diferente por sessão (padrão: todas enviam o mesmo arquivo)')
+    parser.add_argument('--downloads', nargs='*', default=['CSV'], choices=list(FORMATOS_EXPORTACAO))
+    parser.add_argument('--sem-kepler', action='store_true', help='Não pede o mapa Kepler')
+    parser.add_argument('--timeout', type=float, default=600, help='Tempo máximo de cada execução do app (s)')
+    parser.add_argument('--saida', default=None, help='Arquivo JSON com os resultados')
+    parser.add_argument('--comparar', default=None, help='JSON de uma execução anterior para comparação')
+    parser.add_argument('--tolerancia', type=float, default=regressao.TOLERANCIA)
+    args = parser.parse_args(argv)
+
+    if streamlit.__version__ != VERSAO_STREAMLIT:
+        print(f"AVISO: carga.py foi escrito para o Streamlit {VERSAO_STREAMLIT} e usa partes internas dele; "
+              f"instalado: {streamlit.__version__}", file=sys.stderr)
+
+    resultado = {
+        **regressao.iniciar(),
+        **rodar_carga(args.sessoes, interpretar_tamanho(args.linhas), args.dias, args.rodadas,
+                      args.arquivos_distintos, args.downloads, not args.sem_kepler, args.timeout),
+    }
+
+    imprimir_relatorio(resultado)
+    regressao.concluir(resultado, tempos_p95, args.saida, args.comparar, args.tolerancia)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# Estatísticas descritivas em fluxo, com esboços que podem ser juntados.
+#
+# Contagem, média e desvio padrão são mantidos com as fórmulas de Welford e
+# Chan (cada bloco é resumido e somado ao acumulado, sem guardar os valores),
+# e os quantis com um esboço de baldes logarítmicos no estilo do DDSketch:
+# cada valor cai no balde ceil(log(|v|) / log(gama)), e o quantil devolvido
+# tem erro relativo de no máximo ALFA em relação a um valor da coluna com a
+# mesma posição. Dois esboços da mesma coluna (blocos, arquivos ou campanhas
+# diferentes) são juntados somando os baldes.
+import math
+
+import numpy as np
+import pandas as pd
+
+# Erro relativo máximo dos quantis aproximados
+ALFA = 0.01
+
+# Valores com módulo abaixo disso contam no balde do zero
+MINIMO_INDEXAVEL = 1e-9
+
+# Quantis mostrados no describe (os mesmos do pandas)
+QUANTIS_DESCRIBE = [0.25, 0.5, 0.75]
+
+class EsbocoEstatisticas:
+    def __init__(self, alfa=ALFA):
+        self.alfa = alfa
+        self.gama = (1 + alfa) / (1 - alfa)
+        self.log_gama = math.log(self.gama)
+        self.contagem = 0
+        self.media = 0.0
+        self.m2 = 0.0
+        self.minimo = math.inf
+        self.maximo = -math.inf
+        self.zeros = 0
+        self.positivos = {}
+        self.negativos = {}
+
+    # Acrescenta um bloco de valores (nulos são ignorados, como no describe)
+    def atualizar(self, valores):
+        valores = np.asarray(valores, dtype='float64')
+        valores = valores[~np.isnan(valores)]
+        if len(valores) == 0:
+            return self
+        media = valores.mean()
+        self.somar_momentos(len(valores), media, float(((valores - media) ** 2).sum()))
+        self.minimo = min(self.minimo, float(valores.min()))
+        self.maximo = max(self.maximo, float(valores.max()))
+
+        modulo = np.abs(valores)
+        zeros = modulo < MINIMO_INDEXAVEL
+        self.zeros += int(zeros.sum())
+        indices = np.ceil(np.log(np.where(zeros, 1.0, modulo)) / self.log_gama).astype(np.int64)
+        for baldes, selecao in ((self.positivos, ~zeros & (valores > 0)), (self.negativos, ~zeros & (valores < 0))):
+            distintos, contagens = np.unique(indices[selecao], return_counts=True)
+            for indice, contagem in zip(distintos.tolist(), contagens.tolist()):
+                baldes[indice] = baldes.get(indice, 0) + contagem
+        return self
+
+    # Junta os momentos de um bloco (contagem, média e soma dos quadrados dos desvios)
+    def somar_momentos(self, contagem, media, m2):
+        total = self.contagem + contagem
+        delta = media - self.media
+        self.media += delta * contagem / total
+        self.m2 += m2 + delta * delta * self.contagem * contagem / total
+        self.contagem = total
+
+    # Junta outro esboço da mesma coluna neste
+    def juntar(self, outro):
+        if outro.alfa != self.alfa:
+            raise ValueError("Esboços com erros relativos diferentes não podem ser juntados")
+        if outro.contagem == 0:
+            return self
+        self.somar_momentos(outro.contagem, outro.media, outro.m2)
+        self.minimo = min(self.minimo, outro.minimo)
+        self.maximo = max(self.maximo, outro.maximo)
+        self.zeros += outro.zeros
+        for baldes, outros in ((self.positivos, outro.positivos), (self.negativos, outro.negativos)):
+            for indice, contagem in outros.items():
+                baldes[indice] = baldes.get(indice, 0) + contagem
+        return self
+
+    def desvio_padrao(self):
+        return math.sqrt(self.m2 / (self.contagem - 1)) if self.contagem > 1 else math.nan
+
+    # Quantil aproximado (q entre 0 e 1): percorre os baldes do menor valor
+    # para o maior até passar da posição pedida
+    def quantil(self, q):
+        if self.contagem == 0:
+            return math.nan
+        posicao = q * (self.contagem - 1)
+        acumulado = 0
+        baldes = ([(-self.valor_balde(indice), contagem) for indice, contagem in
+                   sorted(self.negativos.items(), reverse=True)]
+                  + [(0.0, self.zeros)]
+                  + [(self.valor_balde(indice), contagem) for indice, contagem in sorted(self.positivos.items())])
+        for valor, contagem in baldes:
+            acumulado += contagem
+            if acumulado > posicao:
+                return min(max(valor, self.minimo), self.maximo)
+        return self.maximo
+
+    # Valor representativo do balde (ponto de erro relativo mínimo)
+    def valor_balde(self, indice):
+        return 2 * self.gama ** indice / (self.gama + 1)
+
+    # Mesmo formato do describe do pandas
+    def descrever(self):
+        vazio = self.contagem == 0
+        return pd.Series(
+            [float(self.contagem), math.nan if vazio else self.media, self.desvio_padrao(),
+             math.nan if vazio else self.minimo]
+            + [self.quantil(q) for q in QUANTIS_DESCRIBE]
+            + [math.nan if vazio else self.maximo],
+            index=['count', 'mean', 'std', 'min'] + [f"{q:.0%}" for q in QUANTIS_DESCRIBE] + ['max'])
+
+    # Forma serializável (só números, listas e dicionários)
+    def como_dict(self):
+        return {
+            'alfa': self.alfa, 'contagem': self.contagem, 'media': self.media, 'm2': self.m2,
+            'minimo': self.minimo, 'maximo': self.maximo, 'zeros': self.zeros,
+            'positivos': dict(self.positivos), 'negativos': dict(self.negativos),
+        }
+
+    @classmethod
+    def de_dict(cls, dados):
+        esboco = cls(dados['alfa'])
+        for campo in ('contagem', 'media', 'm2', 'minimo', 'maximo', 'zeros'):
+            setattr(esboco, campo, dados[campo])
+        esboco.positivos = dict(dados['positivos'])
+        esboco.negativos = dict(dados['negativos'])
+        return esboco
+
+# Esboço de uma coluna alimentado em blocos
+def esbocar_coluna(serie, tamanho_bloco):
+    esboco = EsbocoEstatisticas()
+    valores = serie.to_numpy(dtype='float64', na_value=np.nan)
+    for inicio in range(0, len(valores), tamanho_bloco):
+        esboco.atualizar(valores[inicio:inicio + tamanho_bloco])
+    return esboco
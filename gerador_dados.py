@@ -0,0 +1,130 @@
+# Gerador de exportações sintéticas no formato grouping set, com o cadastro
+# claro.csv correspondente, para testar e medir o pipeline em vários tamanhos.
+#
+# Cada arquivo tem as linhas de total, classe social, gênero x idade, ponto
+# (location_id) e ponto x dia, nos esquemas padrão ou alternativo.
+#
+# Uso:
+#     python gerador_dados.py --linhas 1M --dias 30 --saida dados_sinteticos
+#                             [--esquema alternativo] [--formato parquet]
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from processamento import COLUNAS_ALTERNATIVAS, COLUNAS_PADRAO, LISTA_CLASSES, LISTA_GENERO, LISTA_IDADE
+
+# Fração dos pontos da campanha que não existem no cadastro
+FRACAO_SEM_CADASTRO = 0.02
+
+# Converte tamanhos como '10k', '1M' e '10M' em número de linhas
+def interpretar_tamanho(texto):
+    multiplicadores = {'k': 1_000, 'm': 1_000_000}
+    texto = str(texto).strip().lower()
+    if texto[-1] in multiplicadores:
+        return int(float(texto[:-1]) * multiplicadores[texto[-1]])
+    return int(texto)
+
+# Ids no formato texto com 5 dígitos, como nas exportações reais
+def gerar_ids(quantidade):
+    return np.char.add('BR_', np.char.zfill(np.arange(10000, 10000 + quantidade).astype(str), 5))
+
+# Exportação sintética com aproximadamente 'linhas' linhas. A maior parte é
+# a fatia ponto x dia, então a quantidade de pontos sai de linhas / (dias + 1).
+def gerar_exportacao(linhas, dias=30, esquema='padrao', semente=0, inicio='2024-01-01'):
+    rng = np.random.default_rng(semente)
+    locais = max(1, linhas // (dias + 1))
+    ids = gerar_ids(locais)
+    datas = pd.date_range(inicio, periods=dias).strftime('%Y-%m-%d').to_numpy()
+
+    # Ponto x dia
+    impressoes_dia = rng.integers(10, 5_000, size=locais * dias)
+    por_data = pd.DataFrame({
+        'location_id': np.repeat(ids, dias),
+        'date': np.tile(datas, locais),
+        'impressions': impressoes_dia,
+        'uniques': (impressoes_dia * rng.uniform(0.05, 0.6, size=locais * dias)).astype(np.int64) + 1,
+    })
+
+    # Ponto (campanha inteira)
+    por_ponto = por_data.groupby('location_id', sort=False)[['impressions', 'uniques']].sum().reset_index()
+    por_ponto['uniques'] = (por_ponto['uniques'] * 0.7).astype(np.int64) + 1
+
+    total_impressoes = int(por_ponto['impressions'].sum())
+    total_uniques = int(por_ponto['uniques'].sum() * 0.5) + 1
+
+    # Total, classe social e gênero x idade
+    total = pd.DataFrame({'impressions': [total_impressoes], 'uniques': [total_uniques]})
+    pesos_classe = rng.dirichlet(np.ones(len(LISTA_CLASSES)))
+    por_classe = pd.DataFrame({
+        'class': LISTA_CLASSES,
+        'impressions': (pesos_classe * total_impressoes).astype(np.int64),
+        'uniques': (pesos_classe * total_uniques * 0.9).astype(np.int64),
+    })
+    combinacoes = [(genero, idade) for genero in LISTA_GENERO for idade in LISTA_IDADE]
+    pesos_demografia = rng.dirichlet(np.ones(len(combinacoes)))
+    por_demografia = pd.DataFrame({
+        'gender_group': [genero for genero, _ in combinacoes],
+        'age_group': [idade for _, idade in combinacoes],
+        'impressions': (pesos_demografia * total_impressoes).astype(np.int64),
+        'uniques': (pesos_demografia * total_uniques * 0.8).astype(np.int64),
+    })
+
+    df = pd.concat([total, por_classe, por_demografia, por_ponto, por_data], ignore_index=True)
+    for coluna in COLUNAS_PADRAO:
+        if coluna not in df.columns:
+            df[coluna] = np.nan
+    fim = pd.Timestamp(inicio) + pd.Timedelta(days=dias - 1)
+    df['start_date'] = inicio
+    df['end_date'] = fim.strftime('%Y-%m-%d')
+
+    if esquema == 'alternativo':
+        df = df.rename(columns=dict(zip(COLUNAS_PADRAO, COLUNAS_ALTERNATIVAS)))
+    return df
+
+# Cadastro de pontos com coordenadas, deixando uma fração dos ids da campanha de fora
+def gerar_claro(linhas, dias=30, semente=0):
+    rng = np.random.default_rng(semente + 1)
+    locais = max(1, linhas // (dias + 1))
+    ids = gerar_ids(locais)
+    ids = ids[rng.random(locais) >= FRACAO_SEM_CADASTRO]
+    return pd.DataFrame({
+        'id': ids,
+        'latitude': rng.uniform(-33.5, 5.0, size=len(ids)).round(6),
+        'longitude': rng.uniform(-73.5, -34.8, size=len(ids)).round(6),
+        'cidade': rng.choice(['São Paulo', 'Rio de Janeiro', 'Belo Horizonte', 'Curitiba', 'Recife'], size=len(ids)),
+        'tipo': rng.choice(['Painel', 'Relógio', 'Abrigo', 'Empena'], size=len(ids)),
+    })
+
+# Grava a exportação e o cadastro em 'saida' e retorna os caminhos
+def gravar_dados(saida, linhas, dias=30, esquema='padrao', formato='csv', semente=0):
+    os.makedirs(saida, exist_ok=True)
+    nome = f"campanha_{linhas}_{esquema}.{formato}"
+    caminho = os.path.join(saida, nome)
+    df = gerar_exportacao(linhas, dias, esquema, semente)
+    if formato == 'parquet':
+        df.to_parquet(caminho, index=False)
+    else:
+        df.to_csv(caminho, index=False, encoding='latin-1')
+
+    caminho_claro = os.path.join(saida, f"claro_{linhas}.csv")
+    gerar_claro(linhas, dias, semente).to_csv(caminho_claro, index=False, encoding='latin-1')
+    return caminho, caminho_claro
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Gera exportações sintéticas e o cadastro correspondente.')
+    parser.add_argument('--linhas', default='10k', help="Tamanho aproximado (ex.: 10k, 1M, 10M)")
+    parser.add_argument('--dias', type=int, default=30)
+    parser.add_argument('--esquema', choices=['padrao', 'alternativo'], default='padrao')
+    parser.add_argument('--formato', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--semente', type=int, default=0)
+    parser.add_argument('--saida', default='dados_sinteticos')
+    args = parser.parse_args(argv)
+
+    caminho, caminho_claro = gravar_dados(args.saida, interpretar_tamanho(args.linhas), args.dias,
+                                          args.esquema, args.formato, args.semente)
+    print(f"Exportação: {caminho}\nCadastro: {caminho_claro}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+# Medição das etapas do processamento: tempo de parede, linhas de entrada e
+# saída e pico de memória residente.
+#
+# Cada etapa é envolvida em `with medir('etapa', linhas_entrada=...) as m:` e
+# pode informar `m.linhas_saida`. As medições ficam nas últimas
+# MAX_MEDICOES em memória (para o painel de diagnóstico do app) e são
+# acrescentadas, uma por linha em JSON, ao arquivo LOG_DESEMPENHO para
+# análise posterior. Campos de contexto (por exemplo o dataset) são
+# definidos com `with contexto(dataset=...)` e entram em todas as medições
+# feitas dentro do bloco, na mesma thread. Bibliotecas pesadas usadas só em
+# algumas telas são carregadas com `importar('modulo')` no primeiro uso, e o
+# tempo da importação entra nas medições.
+import contextvars
+import importlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+# Arquivo de log das medições (vazio desliga o log)
+LOG_DESEMPENHO = os.environ.get('LOG_DESEMPENHO', 'desempenho.jsonl')
+
+# Quantidade de medições recentes guardadas em memória
+MAX_MEDICOES = 1000
+
+# Intervalo de amostragem da memória residente durante uma etapa (segundos)
+INTERVALO_AMOSTRAGEM = 0.01
+
+_medicoes = deque(maxlen=MAX_MEDICOES)
+_trava = threading.Lock()
+_contexto = contextvars.ContextVar('contexto_medicao', default={})
+
+# Memória residente atual do processo em bytes (Linux); fora do Linux usa o
+# pico do processo informado pelo sistema
+def rss_atual():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return pico_rss()
+
+# Pico de memória residente do processo desde o início, em bytes
+def pico_rss():
+    fator = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * fator
+
+# Acompanha o pico de memória residente em uma thread separada. Diferente do
+# tracemalloc, não deixa o código medido mais lento e inclui o que o numpy e o
+# Arrow alocam fora do Python. A memória é do processo inteiro: etapas
+# rodando ao mesmo tempo aparecem umas nas outras.
+class MonitorMemoria:
+    def __init__(self):
+        self.inicial = self.pico = rss_atual()
+        self.parar = threading.Event()
+        self.thread = threading.Thread(target=self.amostrar, daemon=True)
+
+    def amostrar(self):
+        while not self.parar.wait(INTERVALO_AMOSTRAGEM):
+            self.pico = max(self.pico, rss_atual())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.parar.set()
+        self.thread.join()
+        self.pico = max(self.pico, rss_atual())
+
+class Medicao:
+    def __init__(self, etapa, linhas_entrada=None):
+        self.etapa = etapa
+        self.linhas_entrada = linhas_entrada
+        self.linhas_saida = None
+
+# Campos acrescentados às medições feitas dentro do bloco
+@contextmanager
+def contexto(**campos):
+    token = _contexto.set({**_contexto.get(), **campos})
+    try:
+        yield
+    finally:
+        _contexto.reset(token)
+
+# Mede uma etapa e registra o resultado (também quando a etapa falha)
+@contextmanager
+def medir(etapa, linhas_entrada=None):
+    medicao = Medicao(etapa, linhas_entrada)
+    monitor = MonitorMemoria()
+    erro = None
+    inicio = time.perf_counter()
+    try:
+        with monitor:
+            yield medicao
+    except BaseException as e:
+        erro = type(e).__name__
+        raise
+    finally:
+        registrar({
+            'momento': datetime.now().isoformat(timespec='milliseconds'),
+            **_contexto.get(),
+            'etapa': etapa,
+            'segundos': round(time.perf_counter() - inicio, 4),
+            'linhas_entrada': medicao.linhas_entrada,
+            'linhas_saida': medicao.linhas_saida,
+            'pico_mb': round(monitor.pico / 2**20, 1),
+            'acrescimo_mb': round((monitor.pico - monitor.inicial) / 2**20, 1),
+            'thread': threading.current_thread().name,
+            'erro': erro,
+        })
+
+def registrar(registro):
+    with _trava:
+        _medicoes.append(registro)
+        if LOG_DESEMPENHO:
+            try:
+                with open(LOG_DESEMPENHO, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(registro, ensure_ascii=False, default=str) + '\n')
+            except OSError:
+                pass
+
+# Importa um módulo no primeiro uso e mede a importação (etapa
+# 'importar <módulo>'). Um módulo que já está em sys.modules ainda pode estar
+# sendo importado por outra sessão: import_module espera a importação terminar
+def importar(nome):
+    if nome in sys.modules:
+        return importlib.import_module(nome)
+    with medir(f"importar {nome}"):
+        return importlib.import_module(nome)
+
+# Medições recentes, opcionalmente só as que têm os campos informados
+def medicoes(**filtros):
+    with _trava:
+        registros = list(_medicoes)
+    return [registro for registro in registros
+            if all(registro.get(campo) == valor for campo, valor in filtros.items())]
@@ -0,0 +1,131 @@
+# Processamento em lote das exportações de campanha, sem a interface Streamlit.
+#
+# Roda o mesmo pipeline do app (junção com o cadastro, normalização do
+# location_id, frequência, agregados por classe/gênero/idade/data e exportações)
+# sobre todos os CSV/Parquet de um diretório, distribuindo os arquivos em um
+# pool de processos, e grava uma tabela-resumo por lote.
+#
+# Uso:
+#     python lote.py ENTRADA [--saida DIR] [--claro claro.csv] [--processos N]
+#                    [--formatos CSV Excel Parquet]
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+import pandas as pd
+
+from instrumentacao import contexto
+from processamento import (CLARO_PATH, FAIXAS_ETARIAS, FORMATOS_EXPORTACAO,
+                           calcular_resultado, carregar_claro, exportar_bytes)
+
+EXTENSOES_ENTRADA = ('.csv', '.parquet')
+
+# Cadastro do processo de trabalho. Com o método 'fork' ele é carregado uma
+# vez no processo principal e herdado pelos trabalhadores sem cópia
+_claro = None
+
+def _iniciar_trabalhador(caminho_claro):
+    global _claro
+    if _claro is None:
+        _claro = carregar_claro(caminho_claro)
+
+# Arquivos CSV/Parquet de um diretório (ou o próprio arquivo informado)
+def listar_arquivos(entrada):
+    if os.path.isfile(entrada):
+        return [entrada]
+    return sorted(os.path.join(entrada, nome) for nome in os.listdir(entrada)
+                  if nome.lower().endswith(EXTENSOES_ENTRADA))
+
+# Uma linha da tabela do lote com os totais e percentuais de um arquivo
+def linha_resumo(arquivo, resultado):
+    resumo = resultado['resumo']
+    linha = {
+        'arquivo': os.path.basename(arquivo),
+        'periodo': resultado['periodo_info'],
+        'quantidade_location_id': resumo['quantidade_location_id'],
+        'sem_cadastro': len(resultado['sem_cadastro']),
+        'alcance': resumo['total_alcance'],
+        'impactos': resumo['total_impactos'],
+    }
+    for classe, porcentagem in resumo['porcentagem_por_classe'].items():
+        linha[f'classe_{classe}_%'] = round(porcentagem, 2)
+    for genero, porcentagem in resumo['porcentagem_por_genero'].items():
+        linha[f'genero_{genero}_%'] = round(porcentagem, 2)
+    for idade, porcentagem in resumo['porcentagem_por_idade'].items():
+        linha[f'idade_{FAIXAS_ETARIAS.get(idade, idade)}_%'] = round(porcentagem, 2)
+    return linha
+
+# Grava as tabelas ponto a ponto e por data nos formatos pedidos
+def exportar_resultado(arquivo, resultado, saida, formatos):
+    base = os.path.splitext(os.path.basename(arquivo))[0]
+    data = datetime.now().strftime('%Y-%m-%d')
+    tabelas = {
+        f"{base}_processado_{data}": resultado['final'],
+        f"{base}_processado_{data} por data": resultado['df_data_filtrado'],
+    }
+    for nome, df in tabelas.items():
+        for formato in formatos:
+            extensao = FORMATOS_EXPORTACAO[formato][0]
+            with open(os.path.join(saida, f"{nome}.{extensao}"), 'wb') as destino:
+                destino.write(exportar_bytes(df, formato))
+
+# Processa um arquivo no trabalhador e devolve só a linha do resumo
+def processar_um(arquivo, saida, formatos):
+    try:
+        with contexto(arquivo=os.path.basename(arquivo), lote=True):
+            resultado = calcular_resultado(arquivo, arquivo, _claro)
+            if saida is not None:
+                exportar_resultado(arquivo, resultado, saida, formatos)
+        return linha_resumo(arquivo, resultado)
+    except Exception as e:
+        return {'arquivo': os.path.basename(arquivo), 'erro': str(e)}
+
+# Processa vários arquivos em paralelo e retorna a tabela-resumo do lote
+def processar_lote(arquivos, saida=None, caminho_claro=CLARO_PATH, processos=None,
+                   formatos=('CSV',)):
+    global _claro
+    _claro = carregar_claro(caminho_claro)
+    if saida is not None:
+        os.makedirs(saida, exist_ok=True)
+
+    metodos = multiprocessing.get_all_start_methods()
+    contexto = multiprocessing.get_context('fork' if 'fork' in metodos else None)
+    linhas = []
+    with ProcessPoolExecutor(max_workers=processos, mp_context=contexto,
+                             initializer=_iniciar_trabalhador, initargs=(caminho_claro,)) as pool:
+        tarefas = {pool.submit(processar_um, arquivo, saida, formatos): arquivo for arquivo in arquivos}
+        for tarefa in as_completed(tarefas):
+            linha = tarefa.result()
+            if 'erro' in linha:
+                print(f"Erro em {linha['arquivo']}: {linha['erro']}", file=sys.stderr)
+            linhas.append(linha)
+
+    resumo = pd.DataFrame(linhas)
+    if not resumo.empty:
+        resumo = resumo.sort_values('arquivo').reset_index(drop=True)
+    return resumo
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Processa em lote as exportações de campanha.')
+    parser.add_argument('entrada', help='Arquivo ou diretório com os CSV/Parquet')
+    parser.add_argument('--saida', default='saida_lote', help='Diretório dos arquivos gerados')
+    parser.add_argument('--claro', default=CLARO_PATH, help='Cadastro de pontos')
+    parser.add_argument('--processos', type=int, default=None, help='Quantidade de processos (padrão: CPUs)')
+    parser.add_argument('--formatos', nargs='*', default=['CSV'], choices=list(FORMATOS_EXPORTACAO),
+                        help='Formatos das exportações por arquivo (nenhum para só o resumo)')
+    args = parser.parse_args(argv)
+
+    arquivos = listar_arquivos(args.entrada)
+    if not arquivos:
+        parser.error(f"Nenhum arquivo CSV/Parquet encontrado em {args.entrada}")
+
+    resumo = processar_lote(arquivos, args.saida, args.claro, args.processos, args.formatos)
+    destino = os.path.join(args.saida, f"resumo_lote_{datetime.now().strftime('%Y-%m-%d')}.csv")
+    resumo.to_csv(destino, index=False)
+    print(f"{len(arquivos)} arquivo(s) processado(s). Resumo em {destino}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,622 @@
+import pandas as pd
+import regex as re
+from io import BytesIO, UnsupportedOperation
+import os
+import hashlib
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from instrumentacao import importar, medir
+from estatisticas import esbocar_coluna
+
+# Copy-on-write: seleções de colunas e fatias viram visões em vez de cópias
+# até serem modificadas (já é o padrão a partir do pandas 3)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.options.mode.copy_on_write = True
+
+# Texto guardado em buffers do Arrow em vez de objetos Python
+TIPO_TEXTO = str if int(pd.__version__.split('.')[0]) >= 3 else 'string[pyarrow]'
+
+# Caminho do arquivo de referência com o cadastro dos pontos
+CLARO_PATH = 'claro.csv'
+
+# Colunas de dimensão dos dois esquemas de exportação, na mesma ordem de papéis
+COLUNAS_PADRAO = ['class', 'location_id', 'gender_group', 'country', 'date', 'age_group', 'impression_hour', 'num_total_impressions', 'home']
+COLUNAS_ALTERNATIVAS = ['social_class', 'location_id', 'gender', 'nationality', 'date', 'age', 'impression_hour', 'num_total_impressions', 'residence_name']
+
+# Fatias do grouping set: cada uma é definida pelas dimensões preenchidas
+# (todas as outras precisam estar nulas)
+FATIAS = {
+    'total': [],
+    'ponto': ['location_id'],
+    'classe': ['class'],
+    'genero_idade': ['gender_group', 'age_group'],
+    'data': ['location_id', 'date'],
+}
+
+# Fatias guardadas no resultado depois do processamento
+FATIAS_MANTIDAS = ['total', 'ponto', 'classe', 'genero_idade']
+
+# Métricas e colunas de período lidas do arquivo principal
+COLUNAS_METRICAS = ['impressions', 'uniques']
+COLUNAS_PERIODO = ['start_date', 'end_date']
+COLUNAS_USADAS = set(COLUNAS_PADRAO + COLUNAS_ALTERNATIVAS + COLUNAS_METRICAS + COLUNAS_PERIODO)
+
+# Tipos fixos da leitura em blocos: dimensões de baixa cardinalidade como
+# categorias; métricas são lidas como float e reduzidas bloco a bloco
+TIPOS_COLUNAS = {
+    'class': 'category', 'social_class': 'category',
+    'gender_group': 'category', 'gender': 'category',
+    'age_group': 'category', 'age': 'category',
+    'country': 'category', 'nationality': 'category',
+    'home': 'category', 'residence_name': 'category',
+    'impression_hour': 'category', 'num_total_impressions': 'category',
+    'location_id': TIPO_TEXTO, 'date': TIPO_TEXTO,
+    'start_date': TIPO_TEXTO, 'end_date': TIPO_TEXTO,
+    'impressions': 'float64', 'uniques': 'float64',
+}
+
+# Linhas por bloco na leitura do CSV
+TAMANHO_BLOCO = 500_000
+
+# Formatos de download: extensão e MIME
+FORMATOS_EXPORTACAO = {
+    'CSV': ('csv', 'text/csv'),
+    'Excel': ('xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'Parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+# Linhas convertidas por vez ao escrever o Excel
+TAMANHO_BLOCO_EXCEL = 50_000
+
+# Categorias exibidas nos percentuais
+LISTA_CLASSES = ['A', 'B1', 'B2', 'C1', 'C2', 'DE']
+LISTA_GENERO = ['F', 'M']
+LISTA_IDADE = [20, 30, 40, 50, 60, 70, 80]
+FAIXAS_ETARIAS = {
+    20: '20-29',
+    30: '30-39',
+    40: '40-49',
+    50: '50-59',
+    60: '60-69',
+    70: '70-79',
+    80: '80+'
+}
+
+# Função para processar a coluna 'location_id'
+def process_location_id(x):
+    # Encontra todos os números na string
+    numbers = re.findall(r'\d+', x)
+    # Junta todos os números em uma única string
+    num_str = ''.join(numbers)
+    # Verifica se a string resultante tem exatamente 5 dígitos
+    if len(num_str) == 5:
+        return num_str
+    else:
+        # Se tiver menos que 5 dígitos, retorna o valor original
+        return x
+
+# Versão vetorizada de process_location_id para uma coluna inteira: a regra
+# é aplicada uma vez por id distinto e o resultado é mapeado de volta
+def normalizar_location_id(serie):
+    with medir('normalizar_location_id', len(serie)) as medicao:
+        codigos, distintos = pd.factorize(serie, sort=False)
+        distintos = pd.Series(distintos, dtype=object).astype(str)
+        digitos = distintos.str.replace(r'\D+', '', regex=True)
+        normalizados = distintos.where(digitos.str.len() != 5, digitos).to_numpy()
+
+        resultado = pd.Series(normalizados.take(codigos), index=serie.index, name=serie.name)
+        medicao.linhas_saida = len(distintos)
+    # Ids nulos continuam nulos
+    return resultado.where(codigos >= 0)
+
+# Assinatura barata do arquivo (mtime + tamanho) para detectar alterações
+def assinatura_arquivo(caminho):
+    info = os.stat(caminho)
+    return info.st_mtime_ns, info.st_size
+
+# Hash MD5 do conteúdo de um arquivo, lido em blocos de 1 MB
+def hash_arquivo(caminho):
+    h = hashlib.md5()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(1 << 20), b''):
+            h.update(bloco)
+    return h.hexdigest()
+
+# Converte o cadastro para uma forma compacta: textos repetidos viram categorias
+# e inteiros são reduzidos ao menor tipo possível
+def compactar_catalogo(claro):
+    for coluna in claro.columns:
+        if coluna == 'location_id':
+            continue
+        serie = claro[coluna]
+        if pd.api.types.is_integer_dtype(serie):
+            claro[coluna] = pd.to_numeric(serie, downcast='integer')
+        elif not pd.api.types.is_numeric_dtype(serie) and serie.nunique() < len(serie) / 2:
+            claro[coluna] = serie.astype('category')
+    return claro
+
+# Lê o cadastro de pontos, renomeia 'id' para 'location_id' e indexa por ele
+def carregar_claro(caminho=CLARO_PATH):
+    with medir('carregar_claro') as medicao:
+        claro = pd.read_csv(caminho, encoding='latin-1', low_memory=False)
+        claro = claro.rename(columns={'id': 'location_id'})
+        claro['location_id'] = claro['location_id'].astype(str)
+        claro = compactar_catalogo(claro).set_index('location_id')
+        # Força a construção da tabela hash do índice antes do primeiro join
+        _ = claro.index.is_unique
+        medicao.linhas_saida = len(claro)
+    return claro
+
+# Escolhe o esquema de colunas do arquivo (padrão ou alternativo)
+def detectar_esquema(colunas):
+    if all(coluna in colunas for coluna in COLUNAS_PADRAO):
+        return COLUNAS_PADRAO
+    return COLUNAS_ALTERNATIVAS
+
+# Máscara de bits com as dimensões preenchidas de cada linha (bit i = coluna i
+# do esquema padrão não nula). Colunas ausentes contam como nulas.
+def mascara_nulos(df):
+    mascara = np.zeros(len(df), dtype=np.uint16)
+    for bit, coluna in enumerate(COLUNAS_PADRAO):
+        if coluna in df.columns:
+            mascara |= df[coluna].notna().to_numpy().astype(np.uint16) << bit
+    return mascara
+
+def padrao_fatia(dimensoes):
+    return sum(1 << COLUNAS_PADRAO.index(coluna) for coluna in dimensoes)
+
+# Separa o arquivo nas fatias do grouping set em uma única passada.
+# No esquema alternativo as colunas são renomeadas para os nomes padrão,
+# assim todas as abas usam os mesmos nomes.
+def classificar_fatias(df):
+    esquema = detectar_esquema(df.columns)
+    if esquema is not COLUNAS_PADRAO:
+        df = df.rename(columns=dict(zip(COLUNAS_ALTERNATIVAS, COLUNAS_PADRAO)))
+
+    mascara = mascara_nulos(df)
+    posicoes = pd.Series(mascara).groupby(mascara, sort=False).indices
+    vazio = np.array([], dtype=np.intp)
+    metricas = [coluna for coluna in COLUNAS_METRICAS if coluna in df.columns]
+
+    # Cada fatia leva só as suas dimensões e as métricas, na ordem do arquivo
+    # (as outras colunas estão vazias nela)
+    fatias = {nome: df.iloc[posicoes.get(padrao_fatia(dimensoes), vazio)][
+                  [coluna for coluna in df.columns if coluna in dimensoes or coluna in metricas]]
+              for nome, dimensoes in FATIAS.items()}
+
+    # Linhas de outros níveis de agregação: só as métricas são mantidas
+    padroes = [padrao_fatia(dimensoes) for dimensoes in FATIAS.values()]
+    resto = np.flatnonzero(~np.isin(mascara, padroes))
+    fatias['outros'] = df.iloc[resto][metricas]
+    return fatias
+
+# Primeira data válida de uma coluna (ou None)
+def primeira_data_valida(serie):
+    datas = pd.to_datetime(serie, errors='coerce').dropna()
+    return datas.iloc[0] if not datas.empty else None
+
+# Texto com o período do arquivo a partir das datas de início e fim
+def descrever_periodo(start_date, end_date, colunas_encontradas=True):
+    if not colunas_encontradas:
+        return "Colunas 'start_date' e/ou 'end_date' não encontradas no arquivo."
+    if start_date is None or end_date is None:
+        return "Não há datas válidas no arquivo."
+    dias = (end_date - start_date).days + 1  # Adiciona 1 ao cálculo dos dias
+    return f"Período do arquivo: {start_date.strftime('%Y-%m-%d')} até {end_date.strftime('%Y-%m-%d')} ({dias} dias)"
+
+# Reduz as métricas para o menor tipo inteiro quando todos os valores são inteiros
+def reduzir_metricas(df):
+    for coluna in COLUNAS_METRICAS:
+        if coluna in df.columns:
+            df[coluna] = pd.to_numeric(df[coluna], downcast='integer')
+    return df
+
+# Após concatenar blocos com categorias diferentes, volta as dimensões para categoria
+def recategorizar(df):
+    for coluna in df.columns:
+        if TIPOS_COLUNAS.get(coluna) == 'category' and not isinstance(df[coluna].dtype, pd.CategoricalDtype):
+            df[coluna] = df[coluna].astype('category')
+    return df
+
+# Distribui blocos de linhas do arquivo nas fatias do grouping set, então o
+# arquivo bruto nunca fica inteiro em memória. As datas do período vêm da
+# primeira linha válida. Retorna as fatias e o texto do período do arquivo.
+def classificar_blocos(blocos, colunas):
+    tipos = {coluna: TIPOS_COLUNAS[coluna] for coluna in colunas}
+    vazias = classificar_fatias(pd.DataFrame(columns=colunas).astype(tipos).drop(columns=COLUNAS_PERIODO, errors='ignore'))
+    partes = {nome: [] for nome in vazias}
+    datas = {coluna: None for coluna in COLUNAS_PERIODO}
+
+    for bloco in blocos:
+        for coluna, valor in datas.items():
+            if valor is None and coluna in bloco.columns:
+                datas[coluna] = primeira_data_valida(bloco[coluna])
+        bloco = reduzir_metricas(bloco.drop(columns=COLUNAS_PERIODO, errors='ignore'))
+
+        for nome, fatia in classificar_fatias(bloco).items():
+            if len(fatia):
+                partes[nome].append(fatia)
+
+    fatias = {nome: recategorizar(pd.concat(lista, ignore_index=True)) if lista else vazias[nome]
+              for nome, lista in partes.items()}
+    periodo_info = descrever_periodo(datas['start_date'], datas['end_date'],
+                                     colunas_encontradas=all(coluna in colunas for coluna in COLUNAS_PERIODO))
+    return fatias, periodo_info
+
+# Tamanho em bytes de um arquivo aberto, usado só no progresso da leitura
+# (None quando o arquivo não informa nem permite descobrir)
+def tamanho_arquivo(arquivo):
+    tamanho = getattr(arquivo, 'size', None)
+    if tamanho is not None:
+        return tamanho
+    try:
+        posicao = arquivo.tell()
+        tamanho = arquivo.seek(0, os.SEEK_END)
+        arquivo.seek(posicao)
+        return tamanho
+    except (OSError, UnsupportedOperation):
+        return None
+
+# Leitura do CSV em blocos com esquema de tipos fixo: só as colunas usadas
+# pelo app são lidas e cada bloco já é distribuído nas fatias do grouping set.
+# Retorna as fatias e o texto do período do arquivo.
+def ler_csv_em_blocos(arquivo, tamanho_bloco=TAMANHO_BLOCO, progresso=None):
+    cabecalho = pd.read_csv(arquivo, encoding='latin-1', nrows=0).columns
+    arquivo.seek(0)
+    colunas = [coluna for coluna in cabecalho if coluna in COLUNAS_USADAS]
+    tipos = {coluna: TIPOS_COLUNAS[coluna] for coluna in colunas}
+    total_bytes = tamanho_arquivo(arquivo)
+
+    def blocos():
+        leitor = pd.read_csv(arquivo, encoding='latin-1', usecols=colunas, dtype=tipos, chunksize=tamanho_bloco,
+                             low_memory=False)
+        for bloco in leitor:
+            yield bloco
+            if progresso is not None and total_bytes:
+                progresso(min(arquivo.tell() / total_bytes, 1.0))
+
+    return classificar_blocos(blocos(), colunas)
+
+# Abre um Parquet (caminho ou bytes do upload) como dataset Arrow
+def abrir_dataset_parquet(origem):
+    if isinstance(origem, (str, os.PathLike)):
+        return ds.dataset(origem, format='parquet')
+    formato = ds.ParquetFileFormat()
+    fragmento = formato.make_fragment(pa.BufferReader(origem))
+    return ds.FileSystemDataset([fragmento], schema=fragmento.physical_schema, format=formato)
+
+# Leitura do Parquet com a API de datasets do Arrow: uma única varredura que
+# projeta só as colunas usadas pelo app. Os lotes do leitor (um ou mais por
+# row group) são juntados até tamanho_bloco linhas e distribuídos nas fatias
+# como no CSV, com as colunas na ordem do arquivo.
+# Retorna as fatias e o texto do período do arquivo.
+def ler_parquet(origem, tamanho_bloco=TAMANHO_BLOCO, progresso=None):
+    dataset = abrir_dataset_parquet(origem)
+    colunas = [coluna for coluna in dataset.schema.names if coluna in COLUNAS_USADAS]
+    total_linhas = dataset.count_rows()
+
+    def blocos():
+        lotes, linhas, lidas = [], 0, 0
+        for lote in dataset.to_batches(columns=colunas, batch_size=tamanho_bloco):
+            lotes.append(lote)
+            linhas += lote.num_rows
+            if linhas >= tamanho_bloco:
+                yield pa.Table.from_batches(lotes).to_pandas()
+                lidas += linhas
+                lotes, linhas = [], 0
+                if progresso is not None and total_linhas:
+                    progresso(min(lidas / total_linhas, 1.0))
+        if lotes:
+            yield pa.Table.from_batches(lotes).to_pandas()
+
+    return classificar_blocos(blocos(), colunas)
+
+# Todos os valores de 'uniques' do arquivo (a soma das fatias cobre todas as linhas)
+def todos_uniques(fatias):
+    return pd.concat([fatia['uniques'] for fatia in fatias.values()], ignore_index=True)
+
+# Quantidade de intervalos do histograma de 'uniques'
+BINS_HISTOGRAMA = 30
+
+# Pontos máximos de uma série temporal enviada para o gráfico
+LIMITE_PONTOS_SERIE = int(os.environ.get('LIMITE_PONTOS_SERIE', 400))
+
+# Histograma de 'uniques' calculado no servidor: só as contagens por intervalo
+# vão para o gráfico
+def histograma_uniques(fatias, bins=BINS_HISTOGRAMA):
+    valores = todos_uniques(fatias).dropna().to_numpy(dtype='float64')
+    if len(valores) == 0:
+        return pd.DataFrame(columns=['uniques', 'inicio', 'fim', 'contagem'])
+    contagens, bordas = np.histogram(valores, bins=bins)
+    return pd.DataFrame({
+        'uniques': (bordas[:-1] + bordas[1:]) / 2,
+        'inicio': bordas[:-1],
+        'fim': bordas[1:],
+        'contagem': contagens,
+    })
+
+# Dados de todos os gráficos da aba de gráficos, já agregados
+def calcular_graficos(fatias, resumo, rollups):
+    classe_df = pd.DataFrame(list(resumo['porcentagem_por_classe'].items()), columns=['Classe Social', 'Porcentagem'])
+
+    idade_df = pd.DataFrame(list(resumo['porcentagem_por_idade'].items()), columns=['Faixa Etária', 'Porcentagem'])
+    idade_df['Faixa Etária'] = idade_df['Faixa Etária'].map(FAIXAS_ETARIAS)
+
+    genero_df = pd.DataFrame(list(resumo['porcentagem_por_genero'].items()), columns=['Gênero', 'Porcentagem'])
+    genero_df['Gênero'] = genero_df['Gênero'].map({'F': 'Feminino', 'M': 'Masculino'})
+
+    # Séries por dia e por semana já agregadas, reduzidas para o gráfico
+    return {
+        'classe': classe_df,
+        'idade': idade_df,
+        'genero': genero_df,
+        'histograma_uniques': histograma_uniques(fatias),
+        'por_data': reduzir_serie(rollups['diario'], LIMITE_PONTOS_SERIE),
+        'por_semana': reduzir_serie(rollups['semanal'], LIMITE_PONTOS_SERIE),
+    }
+
+# Agregados da aba de estatísticas, calculados a partir das fatias: totais,
+# percentuais e estatísticas descritivas das métricas por ponto. O describe é
+# exato (a tabela final já está em memória); os esboços das métricas ficam em
+# resumo['estatisticas'] para juntar com os de outros arquivos
+def calcular_resumo(fatias, final):
+    # Totais de alcance e impactos
+    total_alcance = fatias['total']['uniques'].sum()
+    total_impactos = fatias['total']['impressions'].sum()
+
+    # Somas de 'uniques' por classe
+    df_classe = fatias['classe']
+    total_por_classe = df_classe[df_classe['class'].isin(LISTA_CLASSES)].groupby('class', observed=True)['uniques'].sum().to_dict()
+
+    # Somas de 'uniques' por gênero
+    df_genero = fatias['genero_idade']
+    total_por_genero = df_genero[(df_genero['gender_group'].isin(LISTA_GENERO))].groupby('gender_group', observed=True)['uniques'].sum().to_dict()
+
+    # Somas de 'uniques' por faixa etária (pode vir como categoria de texto: '20', '20.0')
+    idades = pd.to_numeric(df_genero['age_group'].astype(str), errors='coerce')
+    total_por_idade = df_genero['uniques'][idades.isin(LISTA_IDADE)].groupby(idades).sum().to_dict()
+
+    resumo = {
+        'quantidade_location_id': final['location_id'].nunique(),
+        'total_alcance': total_alcance,
+        'total_impactos': total_impactos,
+        'porcentagem_por_classe': {classe: (total / total_alcance) * 100
+                                   for classe, total in total_por_classe.items()},
+        'porcentagem_por_genero': {genero: (total / total_alcance) * 100
+                                   for genero, total in total_por_genero.items()},
+        'porcentagem_por_idade': {idade: (total / total_alcance) * 100
+                                  for idade, total in total_por_idade.items()},
+    }
+    resumo['estatisticas'] = {}
+    for coluna in COLUNAS_METRICAS:
+        if coluna in final.columns:
+            resumo['estatisticas'][coluna] = esbocar_coluna(final[coluna], TAMANHO_BLOCO).como_dict()
+            resumo[f'{coluna}_describe'] = round(final[coluna].describe(), 2)
+    return resumo
+
+# Tabela por local e dia da aba de métricas por data
+def preparar_tabela_datas(fatias):
+    df_data = fatias['data'][['location_id', 'impressions', 'uniques', 'date']]
+    df_data = df_data.assign(date=converter_datas(df_data['date'])).sort_values('date', kind='stable')
+    # O mesmo ponto se repete em todos os dias: categórica guarda cada id uma vez
+    return df_data.assign(location_id=normalizar_location_id(df_data['location_id']).astype('category'))
+
+# Converte as datas uma vez por valor distinto (poucos dias repetidos em
+# muitas linhas) e leva o resultado às linhas pelo código
+def converter_datas(serie):
+    codigos, distintos = pd.factorize(serie, sort=False)
+    datas = pd.DatetimeIndex(pd.to_datetime(pd.Series(distintos, dtype=object)))
+    return pd.Series(datas.take(codigos, allow_fill=True, fill_value=pd.NaT), index=serie.index, name=serie.name)
+
+# Agregados por ponto e dia, por dia e por semana (semanas começando na
+# segunda-feira) em uma única passada sobre a tabela por data: cada linha vira
+# um código (ponto, dia) e as somas saem de um bincount; dia e semana são
+# somados a partir do resultado por ponto e dia, que é bem menor
+def calcular_rollups(df_data):
+    codigos_dia, dias = pd.factorize(df_data['date'], sort=True)
+    codigos_ponto, pontos = pd.factorize(df_data['location_id'], sort=False)
+    validas = (codigos_dia >= 0) & (codigos_ponto >= 0)
+    chave = codigos_ponto[validas].astype(np.int64) * len(dias) + codigos_dia[validas]
+    combinacoes, linha_combinacao = np.unique(chave, return_inverse=True)
+    quantidade_dias = max(len(dias), 1)
+    dia_combinacao = combinacoes % quantidade_dias
+
+    semanas = (dias - pd.to_timedelta(dias.dayofweek, unit='D')).normalize()
+    codigos_semana, semanas = pd.factorize(semanas, sort=True)
+
+    ponto_dia = {'location_id': pontos.take(combinacoes // quantidade_dias), 'date': dias.take(dia_combinacao)}
+    diario = {'date': dias}
+    semanal = {'date': semanas}
+    for coluna in COLUNAS_METRICAS:
+        valores = df_data[coluna].to_numpy()[validas]
+        tipo = np.int64 if valores.dtype.kind in 'iu' else np.float64
+        somas = np.bincount(linha_combinacao, weights=valores.astype(np.float64), minlength=len(combinacoes))
+        por_dia = np.bincount(dia_combinacao, weights=somas, minlength=len(dias))
+        ponto_dia[coluna] = somas.astype(tipo)
+        diario[coluna] = por_dia.astype(tipo)
+        semanal[coluna] = np.bincount(codigos_semana, weights=por_dia, minlength=len(semanas)).astype(tipo)
+
+    # Tabela que já tem uma linha por ponto e dia é reaproveitada sem cópia
+    ja_agregada = validas.all() and len(combinacoes) == len(df_data)
+    return {
+        'ponto_dia': df_data if ja_agregada else pd.DataFrame(ponto_dia),
+        'diario': pd.DataFrame(diario),
+        'semanal': pd.DataFrame(semanal),
+    }
+
+# Reduz uma série por data a no máximo `limite` pontos mantendo, em cada
+# intervalo, as linhas de mínimo e máximo de cada métrica (picos e vales
+# continuam visíveis no gráfico)
+def reduzir_serie(serie, limite, colunas=COLUNAS_METRICAS):
+    colunas = [coluna for coluna in colunas if coluna in serie.columns]
+    por_intervalo = 2 * max(len(colunas), 1)
+    if len(serie) <= limite or limite < por_intervalo:
+        return serie
+    intervalos = np.array_split(np.arange(len(serie)), limite // por_intervalo)
+    manter = set()
+    for posicoes in intervalos:
+        for coluna in colunas:
+            valores = serie[coluna].to_numpy()[posicoes]
+            manter.update((posicoes[np.argmin(valores)], posicoes[np.argmax(valores)]))
+    return serie.iloc[sorted(manter)].reset_index(drop=True)
+
+# Excel com o openpyxl em modo write-only: as linhas são gravadas em fluxo,
+# sem montar a planilha inteira em memória
+def escrever_excel(df, buffer, sheet_name='Dados Processados'):
+    livro = importar('openpyxl').Workbook(write_only=True)
+    planilha = livro.create_sheet(sheet_name)
+    planilha.append([str(coluna) for coluna in df.columns])
+    for inicio in range(0, len(df), TAMANHO_BLOCO_EXCEL):
+        bloco = df.iloc[inicio:inicio + TAMANHO_BLOCO_EXCEL].astype(object)
+        bloco = bloco.where(bloco.notna(), None)
+        for linha in bloco.itertuples(index=False, name=None):
+            planilha.append(linha)
+    livro.save(buffer)
+
+def exportar_bytes(df, formato):
+    buffer = BytesIO()
+    with medir(f'exportar_{formato.lower()}', len(df)) as medicao:
+        if formato == 'CSV':
+            df.to_csv(buffer, index=False)
+        elif formato == 'Excel':
+            escrever_excel(df, buffer)
+        elif formato == 'Parquet':
+            df.to_parquet(buffer, index=False)
+        medicao.linhas_saida = len(df)
+    return buffer.getvalue()
+
+# Junta as linhas por ponto com o cadastro e retorna (final, sem_cadastro).
+# Os ids viram códigos inteiros uma única vez (um por id distinto), que são
+# procurados no índice já construído do cadastro; a junção é feita por posição.
+# As linhas cujo id não existe no cadastro voltam em 'sem_cadastro'.
+def processar_arquivo(fatias, claro):
+    colunas_para_manter = ['location_id', 'impressions', 'uniques']
+
+    df1 = fatias['ponto'].sort_values('impressions', ascending=False, kind='stable')
+    df1 = df1[[coluna for coluna in df1.columns if coluna in colunas_para_manter]].reset_index(drop=True)
+
+    codigos, distintos = pd.factorize(df1['location_id'].astype(str), sort=False)
+
+    if claro.index.is_unique:
+        linha_cadastro = claro.index.get_indexer(distintos)[codigos]
+        encontrados = linha_cadastro >= 0
+        final = pd.concat([df1[encontrados].reset_index(drop=True),
+                           claro.iloc[linha_cadastro[encontrados]].reset_index(drop=True)], axis=1)
+        # Normalização feita uma vez por id distinto e levada às linhas pelo código
+        normalizados = normalizar_location_id(pd.Series(distintos)).to_numpy()
+        final['location_id'] = normalizados.take(codigos[encontrados])
+    else:
+        # Cadastro com ids repetidos: cada repetição gera uma linha, como no merge
+        df1['location_id'] = df1['location_id'].astype(str)
+        final = df1.join(claro, on='location_id', how='inner').reset_index(drop=True)
+        final['location_id'] = normalizar_location_id(final['location_id'])
+        encontrados = np.isin(codigos, np.flatnonzero(distintos.isin(claro.index)))
+
+    sem_cadastro = df1[~encontrados].reset_index(drop=True)
+
+    # Excluir colunas totalmente vazias
+    final = final.dropna(axis=1, how='all')
+
+    return final, sem_cadastro
+
+# Agrega os pontos em células de uma grade regular (em graus), somando
+# impressões e uniques. Cada célula fica no centróide dos seus pontos.
+def agregar_em_grade(final, tamanho_celula):
+    pontos = final[['latitude', 'longitude', 'impressions', 'uniques']].dropna(subset=['latitude', 'longitude'])
+    linha = np.floor(pontos['latitude'].to_numpy() / tamanho_celula).astype(np.int64)
+    coluna = np.floor(pontos['longitude'].to_numpy() / tamanho_celula).astype(np.int64)
+    grade = pontos.groupby([linha, coluna], sort=False).agg(
+        latitude=('latitude', 'mean'),
+        longitude=('longitude', 'mean'),
+        impressions=('impressions', 'sum'),
+        uniques=('uniques', 'sum'),
+        pontos=('latitude', 'size'),
+    ).reset_index(drop=True)
+    grade['frequencia'] = round(grade['impressions'] / grade['uniques'], 2)
+    return grade
+
+# Agrega em grade dobrando o tamanho da célula até caber no limite de pontos
+def agregar_ate_limite(final, limite, tamanho_celula=0.01):
+    grade = agregar_em_grade(final, tamanho_celula)
+    while len(grade) > limite:
+        tamanho_celula *= 2
+        grade = agregar_em_grade(final, tamanho_celula)
+    return grade, tamanho_celula
+
+# Lê um arquivo CSV ou Parquet (caminho, arquivo aberto ou upload) e
+# retorna as fatias do grouping set e o texto do período. A extensão do nome
+# vale em maiúsculas ou minúsculas
+def ler_arquivo(origem, nome, progresso=None):
+    extensao = os.path.splitext(nome)[1].lower()
+    if extensao == '.csv':
+        if isinstance(origem, (str, os.PathLike)):
+            with open(origem, 'rb') as arquivo:
+                return ler_csv_em_blocos(arquivo, progresso=progresso)
+        return ler_csv_em_blocos(origem, progresso=progresso)
+    if extensao == '.parquet':
+        if hasattr(origem, 'getvalue'):
+            origem = origem.getvalue()
+        return ler_parquet(origem, progresso=progresso)
+    raise ValueError(f"Formato de arquivo não suportado: {nome}")
+
+# Etapas do pipeline de um arquivo, na ordem em que rodam
+ETAPAS = {
+    'leitura': 'Lendo arquivo',
+    'juncao': 'Cruzando com o cadastro',
+    'resumo': 'Calculando estatísticas',
+    'tabela_datas': 'Montando a tabela por data',
+    'rollups': 'Agregando por dia e semana',
+    'graficos': 'Preparando gráficos',
+}
+
+# Pipeline completo de um arquivo: leitura, junção com o cadastro, frequência,
+# agregados da aba de estatísticas e tabela por data. `etapa` é chamada no
+# início de cada etapa, e cada parte fica disponível em `parcial` assim que a
+# sua etapa termina (para mostrar resultados enquanto o resto é calculado)
+def calcular_resultado(origem, nome, claro, progresso=None, etapa=None, parcial=None):
+    resultado = {} if parcial is None else parcial
+    etapa = etapa or (lambda nome_etapa: None)
+
+    etapa('leitura')
+    with medir('leitura') as medicao:
+        fatias, periodo_info = ler_arquivo(origem, nome, progresso)
+        medicao.linhas_saida = sum(len(fatia) for fatia in fatias.values())
+    resultado['periodo_info'] = periodo_info
+
+    # Processamento do arquivo
+    etapa('juncao')
+    with medir('processar_arquivo') as medicao:
+        final, sem_cadastro = processar_arquivo(fatias, claro)
+
+        # Criar coluna frequência
+        final['frequencia'] = round(final['impressions']/final['uniques'], 2)
+        medicao.linhas_entrada, medicao.linhas_saida = len(fatias['ponto']), len(final)
+    resultado['sem_cadastro'] = sem_cadastro
+    resultado['final'] = final
+
+    etapa('resumo')
+    with medir('calcular_resumo', len(final)):
+        resumo = calcular_resumo(fatias, final)
+    resultado['resumo'] = resumo
+
+    etapa('tabela_datas')
+    with medir('preparar_tabela_datas') as medicao:
+        df_data_filtrado = preparar_tabela_datas(fatias)
+        medicao.linhas_entrada = medicao.linhas_saida = len(df_data_filtrado)
+    resultado['df_data_filtrado'] = df_data_filtrado
+
+    etapa('rollups')
+    with medir('calcular_rollups', len(df_data_filtrado)) as medicao:
+        rollups = calcular_rollups(df_data_filtrado)
+        medicao.linhas_saida = sum(len(tabela) for tabela in rollups.values())
+    resultado['rollups'] = rollups
+
+    etapa('graficos')
+    with medir('calcular_graficos'):
+        resultado['graficos'] = calcular_graficos(fatias, resumo, rollups)
+
+    # As fatias 'data' e 'outros' (as maiores) já estão representadas na
+    # tabela por data e nos gráficos; só as pequenas ficam no resultado
+    resultado['fatias'] = {nome: fatias[nome] for nome in FATIAS_MANTIDAS}
+    return resultado
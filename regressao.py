@@ -0,0 +1,54 @@
+# Resultados do benchmark e do teste de carga: cabeçalho da execução,
+# gravação em JSON e comparação com uma execução anterior.
+#
+# Cada script informa como tirar do seu resultado os tempos comparáveis, um
+# dicionário {nome: segundos}; os que ficaram mais lentos que a base além da
+# tolerância são regressões, impressas em stderr, e o comando sai com código 1.
+import json
+import os
+import platform
+import sys
+from datetime import datetime
+
+import instrumentacao
+
+# Tolerância padrão (fração) antes de considerar um tempo mais lento como regressão
+TOLERANCIA = 0.2
+
+# Tempos mais curtos que isso oscilam demais para comparar
+MINIMO_SEGUNDOS = 0.05
+
+# Início da execução: os scripts gravam os próprios resultados, então as
+# medições internas das etapas não vão para o log de desempenho do app.
+# Retorna os campos comuns do resultado
+def iniciar():
+    instrumentacao.LOG_DESEMPENHO = ''
+    return {
+        'data': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+    }
+
+# Tempos que ficaram mais lentos que a base além da tolerância:
+# lista de (nome, segundos na base, segundos agora)
+def comparar(atual, base, tolerancia=TOLERANCIA):
+    regressoes = []
+    for nome, segundos in atual.items():
+        anterior = base.get(nome)
+        if anterior is not None and anterior >= MINIMO_SEGUNDOS and segundos > anterior * (1 + tolerancia):
+            regressoes.append((nome, anterior, segundos))
+    return regressoes
+
+# Grava o resultado em `saida` (se informado) e o compara com o JSON em
+# `caminho_base` (se existe); `tempos` extrai {nome: segundos} de um resultado
+def concluir(resultado, tempos, saida=None, caminho_base=None, tolerancia=TOLERANCIA):
+    if saida:
+        with open(saida, 'w') as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+
+    if caminho_base and os.path.exists(caminho_base):
+        with open(caminho_base) as f:
+            regressoes = comparar(tempos(resultado), tempos(json.load(f)), tolerancia)
+        for nome, anterior, atual in regressoes:
+            print(f"REGRESSÃO {nome}: {anterior:.3f}s -> {atual:.3f}s", file=sys.stderr)
+        if regressoes:
+            sys.exit(1)
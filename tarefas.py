@@ -0,0 +1,115 @@
+# Execução das etapas pesadas em segundo plano.
+#
+# Cada tarefa roda em um pool de threads compartilhado pelo processo, publica a
+# etapa atual e a fração concluída e pode ser cancelada: o cancelamento é
+# verificado sempre que a tarefa informa progresso, e a tarefa termina com
+# TarefaCancelada. Tarefas com a mesma chave são compartilhadas entre as
+# sessões interessadas e só são canceladas quando nenhuma delas espera mais
+# pelo resultado. Uma tarefa concluída que ninguém consulta por VALIDADE
+# segundos (a sessão que esperava foi fechada, por exemplo) é esquecida, para
+# não segurar o resultado na memória.
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Tempo (s) que uma tarefa concluída fica guardada sem ser consultada
+VALIDADE = 300
+
+class TarefaCancelada(Exception):
+    pass
+
+class Tarefa:
+    def __init__(self, chave):
+        self.chave = chave
+        self.etapa = None
+        self.fracao = 0.0
+        self.interessados = set()
+        # Partes do resultado publicadas pela tarefa antes de terminar
+        self.parcial = {}
+        self.cancelada = threading.Event()
+        self.futuro = None
+        # Última consulta de uma sessão ou conclusão da tarefa
+        self.ultimo_uso = time.monotonic()
+
+    # Marca a consulta da tarefa (também chamado pelo futuro ao terminar)
+    def usar(self, *_):
+        self.ultimo_uso = time.monotonic()
+
+    def verificar(self):
+        if self.cancelada.is_set():
+            raise TarefaCancelada(self.chave)
+
+    # Início de uma etapa (zera a fração)
+    def avancar(self, etapa):
+        self.verificar()
+        self.etapa = etapa
+        self.fracao = 0.0
+
+    # Progresso dentro da etapa atual, de 0 a 1
+    def progresso(self, fracao):
+        self.verificar()
+        self.fracao = fracao
+
+    def cancelar(self):
+        self.cancelada.set()
+        self.futuro.cancel()
+
+    def concluida(self):
+        return self.futuro.done()
+
+    def resultado(self):
+        return self.futuro.result()
+
+class GerenciadorTarefas:
+    def __init__(self, max_trabalhadores=None, validade=VALIDADE):
+        self.executor = ThreadPoolExecutor(max_workers=max_trabalhadores, thread_name_prefix='tarefa')
+        self.validade = validade
+        self.tarefas = {}
+        self.trava = threading.Lock()
+
+    # Inicia a tarefa `funcao(tarefa, *args)` ou, se já existe uma com a mesma
+    # chave, só registra o interessado nela
+    def submeter(self, chave, interessado, funcao, *args):
+        with self.trava:
+            self.expirar()
+            tarefa = self.tarefas.get(chave)
+            if tarefa is None or tarefa.cancelada.is_set():
+                tarefa = Tarefa(chave)
+                tarefa.futuro = self.executor.submit(funcao, tarefa, *args)
+                tarefa.futuro.add_done_callback(tarefa.usar)
+                self.tarefas[chave] = tarefa
+            tarefa.interessados.add(interessado)
+            tarefa.usar()
+            return tarefa
+
+    # O interessado não espera mais a tarefa; sem interessados, ela é
+    # cancelada (se ainda roda) e esquecida
+    def liberar(self, chave, interessado):
+        with self.trava:
+            self.expirar()
+            tarefa = self.tarefas.get(chave)
+            if tarefa is None:
+                return
+            tarefa.interessados.discard(interessado)
+            if not tarefa.interessados:
+                if not tarefa.concluida():
+                    tarefa.cancelar()
+                del self.tarefas[chave]
+
+    # Tarefa registrada com a chave (rodando ou concluída), ou None
+    def obter(self, chave):
+        with self.trava:
+            return self.tarefas.get(chave)
+
+    # Esquece uma tarefa concluída (o resultado já foi guardado por quem chamou)
+    def remover(self, chave):
+        with self.trava:
+            self.tarefas.pop(chave, None)
+
+    # Esquece as tarefas concluídas sem consulta há mais de `validade` segundos
+    # (chamado com a trava adquirida)
+    def expirar(self):
+        limite = time.monotonic() - self.validade
+        for chave, tarefa in list(self.tarefas.items()):
+            if tarefa.concluida() and tarefa.ultimo_uso < limite:
+                del self.tarefas[chave]